@@ -0,0 +1,68 @@
+"""Python API of smally, for callers like an upload handler.
+
+    >>> import api
+    >>> r = api.optimize('uploads/2019/01/stepstone.jpg')
+    >>> r.saved, r.note
+    (2246, '-2246 -9.16% [p] (libjpeg-turbo -copy none -progressive)')
+
+Errors are raised, never sys.exit. The actions behind are created once
+and kept warm, so calls from many threads share them.
+"""
+import os
+import threading
+from classes import (sh, pJpegtran, pOptipng, pGifsicle, SmallyError,
+                     FILE_WRONG, FILE_NOTPIC, NAME)
+
+
+JPG = ('.jpg', '.jpeg')
+PNG = ('.png',)
+GIF = ('.gif',)
+LEVELS = ('o0','o1','o2','o3','o4','o5','o6','o7','o7 -zm1-9')
+_actions = {}           # (tool, level, keepmtime): idle walk action
+_lock = threading.Lock()
+
+
+def _action(tool, level, keepmtime):
+    """idle action of tool, created at first use"""
+    key = (tool, level, keepmtime)
+    with _lock:
+        if key in _actions: return _actions[key]
+        if not _actions:
+            sh.fallback = sh.which('identify', silent=True)
+        if sh.which(tool, silent=True) is False:
+            raise SmallyError('%s: %s can not be found in $PATH'
+                              % (NAME, tool))
+        if tool == 'jpegtran':
+            act = pJpegtran(list(JPG), 0.0, False, None, None, None,
+                            keepmtime)
+        elif tool == 'gifsicle':
+            act = pGifsicle(list(GIF), 0.0, False, None, None, None,
+                            keepmtime)
+        else:
+            act = pOptipng(list(PNG), 0.0, False, None, None, None,
+                           keepmtime, level)
+        _actions[key] = act
+        return act
+
+
+def optimize(pathname, level='o2', keepmtime=False):
+    """compress a JPG by jpegtran, a PNG by optipng -level or a GIF by
+    gifsicle -O3 losslessly,
+    return result(path, tool, before, after, saved, note)"""
+    _, ext = os.path.splitext(pathname)
+    if ext.lower() in JPG:
+        act = _action('jpegtran', None, keepmtime)
+    elif ext.lower() in PNG:
+        if level not in LEVELS:
+            raise SmallyError('%s: wrong optipng level %s' % (NAME, level))
+        act = _action('optipng', level, keepmtime)
+    elif ext.lower() in GIF:
+        act = _action('gifsicle', None, keepmtime)
+    else:
+        raise SmallyError(pathname + FILE_NOTPIC)
+    if not os.path.isfile(pathname):
+        raise FileNotFoundError(pathname)
+    if (sh.identify(pathname) is False or
+            os.path.basename(pathname)[0] == '-'):
+        raise SmallyError(pathname + FILE_WRONG)
+    return act.optimize(pathname)
@@ -0,0 +1,71 @@
+import subprocess
+from header import header
+
+
+class backend():
+    """The installed jpegtran, and the lossless candidates it offers.
+
+    The flavor, mozjpeg, libjpeg-turbo or the IJG libjpeg, is read from
+    jpegtran -version, and the switches it knows from its usage text.
+    mozjpeg is progressive with optimized scans by default, so its
+    baseline candidate needs -revert. Arithmetic coding is a candidate only
+    if asked for, since most browsers can not decode it. copy is none, icc,
+    all, or auto: all markers are kept for a JPG rotated by EXIF
+    orientation, the ICC profile for a JPG having one, and none for others.
+    """
+    COPY = ('none', 'icc', 'all', 'auto')
+
+    def __init__(it, arithmetic=False, copy='none'):
+        it.copy = copy
+        it.version = it.run('-version')
+        low = it.version.lower()
+        it.flavor = ('mozjpeg' if 'mozjpeg' in low else
+                     'libjpeg-turbo' if 'turbo' in low else 'libjpeg')
+        usage = it.run('-usage-of-smally')
+        it.icc = '-copy icc' in usage
+        it.arithmetic = arithmetic and '-arithmetic' in usage
+        moz = it.flavor == 'mozjpeg'
+        # mode: (switches, name), 0 is the original
+        it.modes = {1: (['-revert','-optimize'] if moz else ['-optimize'],
+                        'baseline'),
+                    2: ([] if moz else ['-progressive'], 'progressive')}
+        if it.arithmetic:
+            it.modes[3] = (['-arithmetic'], 'arithmetic')
+
+    @staticmethod
+    def run(switch):
+        """all the text jpegtran prints with switch"""
+        try:
+            p = subprocess.run(['jpegtran', switch], stdin=subprocess.DEVNULL,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE, timeout=10)
+        except (OSError, subprocess.TimeoutExpired):
+            return ''
+        return (p.stdout + p.stderr).decode(errors='replace').strip()
+
+    def name(it):
+        """flavor and version"""
+        line = it.version.splitlines()[0] if it.version else ''
+        for word in line.split():
+            if word[:1].isdigit(): return it.flavor + ' ' + word
+        return it.flavor
+
+    def copies(it, pathname):
+        """-copy of pathname"""
+        copy = it.copy
+        if copy == 'auto':
+            meta = header.jpgmeta(pathname)
+            icc, orientation = meta if meta is not None else (False, 0)
+            copy = ('all' if orientation > 1 else
+                    'icc' if icc else 'none')
+        if copy == 'icc' and not it.icc: copy = 'all'
+        return copy
+
+    def argv(it, mode, copy, pathname):
+        return (['jpegtran','-copy',copy] + it.modes[mode][0]
+                + [pathname])
+
+    def flags(it, mode, copy):
+        """shown after the winner, like (mozjpeg -copy none -arithmetic)"""
+        return ' '.join(['(' + it.flavor, '-copy', copy]
+                        + it.modes[mode][0]) + ')'
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""Benchmark of smally with a synthetic picture corpus.
+
+    $ python3 bench.py gen corpus --seed 1 --files 400
+    $ python3 bench.py run corpus -j 4 --save base.json
+    $ python3 bench.py run corpus -j 4 --compare base.json
+"""
+import os
+import sys
+import json
+import time
+import zlib
+import random
+import shutil
+import struct
+import logging
+import argparse
+import tempfile
+from classes import sh, walk, pShow, pSize, pJpegtran, pOptipng, NAME
+
+
+log = logging.getLogger()
+
+
+class jpg():
+    """Minimal baseline JPG writer.
+
+    The DCT coefficients are made up directly (a smooth DC field plus a few
+    low frequency ACs), so there is no DCT to compute, and the file is
+    coded by flat 4-bit/8-bit Huffman tables, which leaves real work to
+    jpegtran -optimize. YCbCr 4:4:4, one quantization table of all 1s.
+    """
+    LOW_AC = 10  # only the first ACs in zigzag order may be non-zero
+
+    @staticmethod
+    def huff(nsym, length):
+        """canonical table of nsym symbols, all codes in length bits"""
+        bits = [0]*16
+        bits[length-1] = nsym
+        return bits, {i: (i, length) for i in range(nsym)}
+
+    @staticmethod
+    def category(v):
+        return abs(v).bit_length()
+
+    @staticmethod
+    def write(pathname, w, h, rnd, exif=0):
+        dc_bits, dc_code = jpg.huff(12, 4)
+        ac_syms = [0x00, 0xf0] + [(r << 4) | s for r in range(16)
+                                  for s in range(1, 11)]
+        ac_bits, codes = jpg.huff(len(ac_syms), 8)
+        ac_code = {sym: codes[i] for i, sym in enumerate(ac_syms)}
+        out = bytearray()
+        acc, nacc = 0, 0
+
+        def put(code, length):
+            nonlocal acc, nacc
+            acc = (acc << length) | code
+            nacc += length
+            while nacc >= 8:
+                nacc -= 8
+                b = (acc >> nacc) & 0xff
+                out.append(b)
+                if b == 0xff: out.append(0)
+            acc &= (1 << nacc) - 1
+
+        def value(v):
+            n = jpg.category(v)
+            if n: put(v if v > 0 else v + (1 << n) - 1, n)
+
+        bw, bh = (w+7)//8, (h+7)//8
+        pred = [0, 0, 0]
+        phase = [rnd.uniform(0, 6.28) for _ in range(3)]
+        for by in range(bh):
+            for bx in range(bw):
+                for c in range(3):
+                    amp = 400 if c == 0 else 120
+                    dc = int(amp * (((bx*7 + by*3 + phase[c]*50) % 97)/97.0
+                                    - 0.5)) + rnd.randint(-8, 8)
+                    diff = dc - pred[c]
+                    pred[c] = dc
+                    put(*dc_code[jpg.category(diff)])
+                    value(diff)
+                    run = 0
+                    for k in range(1, jpg.LOW_AC):
+                        v = rnd.randint(-30, 30) if rnd.random() < 0.5 \
+                            else 0
+                        if v == 0:
+                            run += 1
+                            continue
+                        put(*ac_code[(run << 4) | jpg.category(v)])
+                        value(v)
+                        run = 0
+                    put(*ac_code[0x00])  # EOB, the rest are all zero
+        if nacc: put((1 << (8-nacc)) - 1, 8-nacc)
+
+        def seg(marker, data):
+            return b'\xff' + bytes([marker]) \
+                   + struct.pack('>H', len(data)+2) + data
+        head = b'\xff\xd8'
+        head += seg(0xe0, b'JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00')
+        if exif:
+            tiff = b'II*\x00\x08\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+            head += seg(0xe1, b'Exif\x00\x00' + tiff + bytes(exif))
+        head += seg(0xdb, b'\x00' + b'\x01'*64)
+        head += seg(0xc0, struct.pack('>BHHB', 8, h, w, 3)
+                    + b'\x01\x11\x00\x02\x11\x00\x03\x11\x00')
+        head += seg(0xc4, b'\x00' + bytes(dc_bits) + bytes(range(12))
+                    + b'\x10' + bytes(ac_bits) + bytes(ac_syms))
+        head += seg(0xda, b'\x03\x01\x00\x02\x00\x03\x00\x00\x3f\x00')
+        with open(pathname, 'wb') as f:
+            f.write(head + bytes(out) + b'\xff\xd9')
+
+
+def png(pathname, w, h, rnd):
+    """RGB PNG, gradient with noise, zlib level 1 leaves work to optipng"""
+    def chunk(t, d):
+        return (struct.pack('>I', len(d)) + t + d
+                + struct.pack('>I', zlib.crc32(t+d)))
+    red = bytes(x*255//w for x in range(w))
+    rows = bytearray()
+    for y in range(h):
+        noise = rnd.randbytes(w)
+        row = bytearray(w*3)
+        row[0::3] = bytes((r + (n & 3)) & 0xff for r, n in zip(red, noise))
+        row[1::3] = bytes([y*255//h]) * w
+        row[2::3] = bytes((x+y) & 0xff for x in range(w))
+        rows.append(0)
+        rows += row
+    with open(pathname, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n'
+                + chunk(b'IHDR', struct.pack('>IIBBBBB', w, h, 8, 2, 0, 0, 0))
+                + chunk(b'IDAT', zlib.compress(bytes(rows), 1))
+                + chunk(b'IEND', b''))
+
+
+def gen(top, seed, files, depth, width):
+    """Reproducible corpus: mixed size JPGs (baseline/progressive, with or
+    without EXIF), PNGs, bogus files with picture extension, one deep
+    chain of folders and one wide folder."""
+    rnd = random.Random(seed)
+    if os.path.exists(top) and os.listdir(top):
+        raise FileExistsError('%s is not empty' % top)
+    deep = os.path.join(top, *['d%d' % i for i in range(depth)])
+    wide = os.path.join(top, 'wide')
+    os.makedirs(deep)
+    os.makedirs(wide)
+    folders = [os.path.join(top, *['d%d' % i for i in range(n)])
+               for n in range(depth+1)]
+    progressive = sh.which('jpegtran', silent=True)
+    if not progressive:
+        log.info('%s: jpegtran not found, no progressive JPGs in corpus'
+                 % NAME)
+    for i in range(files):
+        folder = wide if i < width else rnd.choice(folders)
+        w, h = rnd.choice(((64,48),(150,150),(300,200),(768,512),
+                           (1024,683),(1600,1067)))
+        kind = rnd.random()
+        if kind < 0.6:
+            pathname = os.path.join(folder, 'p%05d.jpg' % i)
+            jpg.write(pathname, w, h, rnd,
+                      exif=rnd.choice((0, 0, 2048, 16384)))
+            if progressive and rnd.random() < 0.4:
+                rcode, out, _ = sh.run(['jpegtran','-copy','all',
+                                        '-progressive',pathname])
+                if rcode == 0:
+                    with open(pathname, 'wb') as f: f.write(out)
+        elif kind < 0.95:
+            pathname = os.path.join(folder, 'p%05d.png' % i)
+            png(pathname, w//2, h//2, rnd)
+        else:
+            pathname = os.path.join(folder, 'bogus%05d.%s'
+                                    % (i, rnd.choice(('jpg','png'))))
+            with open(pathname, 'wb') as f:
+                f.write(rnd.randbytes(512))
+
+
+def corpusInfo(top):
+    nfiles, nbytes = 0, 0
+    for root, _, names in os.walk(top):
+        for name in names:
+            nfiles += 1
+            nbytes += os.path.getsize(os.path.join(root, name))
+    return nfiles, nbytes
+
+
+class phases(walk):
+    """walk only, or walk and check, without do"""
+    def __init__(it, ptype, top, check, **kw):
+        super().__init__(ptype, 0.0, True, None, **kw)
+        for path in top:
+            for pathname, st in it.candidates(it.scan(path)):
+                if check: it.check(pathname, st)
+
+
+def measure(name, top, jobs):
+    """time one phase or action on a fresh copy of corpus"""
+    scratch = tempfile.mkdtemp(prefix='smally_bench_')
+    try:
+        work = os.path.join(scratch, 'corpus')
+        shutil.copytree(top, work)
+        nfiles, nbytes = corpusInfo(work)
+        jpg_png = ['.jpg','.jpeg','.png']
+        sh.spawned = 0
+        t0 = time.perf_counter()
+        if name == 'walk':
+            phases(jpg_png, [work], False)
+        elif name == 'check':
+            phases(jpg_png, [work], True)
+        elif name == 'show':
+            pShow(jpg_png, 0.0, True, None, [work], None, jobs=jobs)
+        elif name == 'size':
+            pSize(jpg_png, 0.0, True, None, [work], None, jobs=jobs)
+        elif name == 'jpegtran':
+            pJpegtran(['.jpg','.jpeg'], 0.0, True, None, [work], None,
+                      False, jobs=jobs)
+        elif name == 'optipng':
+            pOptipng(['.png'], 0.0, True, None, [work], None, False, 'o2',
+                     jobs=jobs)
+        seconds = time.perf_counter() - t0
+        _, after = corpusInfo(work)
+        return {'seconds': seconds,
+                'files_per_sec': nfiles/seconds,
+                'bytes_per_sec': nbytes/seconds,
+                'subprocesses': sh.spawned,
+                'saved': nbytes - after}
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def run(top, names, jobs, repeat):
+    """best of repeat for each name"""
+    sh.fallback = sh.which('identify', silent=True)
+    result = {}
+    level = log.level
+    for name in names:
+        if name in ('jpegtran','optipng') and not sh.which(name):
+            continue
+        log.setLevel(logging.ERROR)  # mute per-file lines
+        try:
+            best = min((measure(name, top, jobs) for _ in range(repeat)),
+                       key=lambda r: r['seconds'])
+        finally:
+            log.setLevel(level)
+        result[name] = best
+        log.info('%s: %-8s %8.3fs %10.1f files/s %12.1f B/s '
+                 '%6d subprocesses %10d saved'
+                 % (NAME, name, best['seconds'], best['files_per_sec'],
+                    best['bytes_per_sec'], best['subprocesses'],
+                    best['saved']))
+    return result
+
+
+def compare(result, base, tolerance):
+    """return names of regressed phases"""
+    bad = []
+    for name, r in result.items():
+        if name not in base: continue
+        b = base[name]
+        ratio = r['files_per_sec'] / b['files_per_sec']
+        mark = ''
+        if ratio < 1 - tolerance or r['subprocesses'] > b['subprocesses']:
+            mark = '  <-- regression'
+            bad.append(name)
+        log.info('%s: %-8s %.2fx files/s, subprocesses %d -> %d%s'
+                 % (NAME, name, ratio, b['subprocesses'],
+                    r['subprocesses'], mark))
+    return bad
+
+
+def main():
+    logging.basicConfig(stream=sys.stdout,
+                        format='%(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser(description='benchmark of smally')
+    sub = parser.add_subparsers(dest='cmd', required=True)
+    g = sub.add_parser('gen', help='generate synthetic corpus')
+    g.add_argument('top')
+    g.add_argument('--seed', type=int, default=1)
+    g.add_argument('--files', type=int, default=400)
+    g.add_argument('--depth', type=int, default=12,
+                   help='depth of the deep folder chain')
+    g.add_argument('--width', type=int, default=100,
+                   help='number of files in the wide folder')
+    r = sub.add_parser('run', help='time phases and actions on corpus')
+    r.add_argument('top')
+    r.add_argument('-j', type=int, default=1, dest='jobs')
+    r.add_argument('--phases',
+                   default='walk,check,show,size,jpegtran,optipng')
+    r.add_argument('--repeat', type=int, default=3)
+    r.add_argument('--save', metavar='JSON')
+    r.add_argument('--compare', metavar='JSON')
+    r.add_argument('--tolerance', type=float, default=0.1,
+                   help='slowdown tolerated by --compare, default 0.1')
+    args = parser.parse_args()
+    if args.cmd == 'gen':
+        gen(args.top, args.seed, args.files, args.depth, args.width)
+        nfiles, nbytes = corpusInfo(args.top)
+        log.info('%s: corpus %s: %d files, %d bytes'
+                 % (NAME, args.top, nfiles, nbytes))
+        return
+    result = run(args.top, args.phases.split(','), args.jobs, args.repeat)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(result, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            base = json.load(f)
+        if compare(result, base, args.tolerance): sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+
+
+class cache():
+    """Persistent cache of already optimized pictures.
+
+    Each record is keyed on (st_dev, st_ino, tool) and remembers st_size and
+    st_mtime_ns after compressing, with the tool version and level used.
+    A file is a hit only if all of them are the same. With use_hash, the
+    sha1 of content is stored as well, and looked up when the stat key
+    misses, e.g. the file is restored from backup with a new inode or mtime.
+    """
+    COMMIT_EVERY = 100
+
+    def __init__(it, dbfile, tool, version, level, use_hash=False):
+        it.tool = tool
+        it.version = version
+        it.level = level
+        it.use_hash = use_hash
+        it.lock = threading.Lock()
+        it.dirty = 0
+        it.db = sqlite3.connect(dbfile, check_same_thread=False)
+        it.db.execute('create table if not exists done ('
+                      'dev integer, ino integer, tool text, '
+                      'size integer, mtime_ns integer, hash text, '
+                      'version text, level text, result text, '
+                      'saved integer, ts real, '
+                      'primary key (dev, ino, tool))')
+        it.db.execute('create index if not exists done_hash '
+                      'on done (hash, tool)')
+        it.db.commit()
+
+    @staticmethod
+    def digest(pathname):
+        """sha1 of file content"""
+        h = hashlib.sha1()
+        with open(pathname, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        return h.hexdigest()
+
+    def hit(it, pathname, st=None):
+        """True if pathname is unchanged since it was optimized"""
+        if st is None: st = os.stat(pathname)
+        with it.lock:
+            row = it.db.execute(
+                'select size, mtime_ns, version, level from done '
+                'where dev=? and ino=? and tool=?',
+                (st.st_dev, st.st_ino, it.tool)).fetchone()
+        if row == (st.st_size, st.st_mtime_ns, it.version, it.level):
+            return True
+        if not it.use_hash:
+            return False
+        h = it.digest(pathname)
+        with it.lock:
+            row = it.db.execute(
+                'select result, saved from done where hash=? and tool=? '
+                'and size=? and version=? and level=?',
+                (h, it.tool, st.st_size, it.version, it.level)).fetchone()
+        if row is None:
+            return False
+        it.put(pathname, row[0], row[1], st, h)  # refresh the stat key
+        return True
+
+    def seen(it, st):
+        """True if the file is optimized by tool before, with any version
+        or level"""
+        with it.lock:
+            row = it.db.execute(
+                'select size, mtime_ns from done '
+                'where dev=? and ino=? and tool=?',
+                (st.st_dev, st.st_ino, it.tool)).fetchone()
+        return row == (st.st_size, st.st_mtime_ns)
+
+    def put(it, pathname, result, saved=0, st=None, h=None):
+        """record pathname as optimized, call after it is written back"""
+        if st is None: st = os.stat(pathname)
+        if h is None and it.use_hash: h = it.digest(pathname)
+        with it.lock:
+            it.db.execute(
+                'insert or replace into done values '
+                '(?,?,?,?,?,?,?,?,?,?,?)',
+                (st.st_dev, st.st_ino, it.tool, st.st_size, st.st_mtime_ns,
+                 h, it.version, it.level, result, saved, time.time()))
+            it.dirty += 1
+            if it.dirty >= it.COMMIT_EVERY:
+                it.db.commit()
+                it.dirty = 0
+
+    def close(it):
+        with it.lock:
+            it.db.commit()
+            it.db.close()
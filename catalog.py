@@ -0,0 +1,222 @@
+import os
+import time
+import sqlite3
+import threading
+from header import header
+from classes import sh, SmallyError
+
+
+class catalog():
+    """SQLite catalog of pictures, --show and --size answer from it.
+
+    Each picture has its size, dimensions, type, progressive flag, mtime,
+    the last result of smally compressing it, and if it is valid, checked
+    by header or identify as walk does. Invalid files are only kept to be
+    reported as errors. refresh only rescans the folders whose mtime
+    changed since the last refresh, the others are taken from the catalog
+    with their sub-folders, so an unchanged tree costs one stat per
+    folder. A file rewritten in place does not change the mtime of its
+    folder and is not seen, smally itself always writes back by rename.
+    """
+    EXTS = ('.jpg', '.jpeg', '.png', '.gif', '.webp')
+    COMMIT_EVERY = 1000
+    COLUMNS = ('path', 'dir', 'ext', 'size', 'width', 'height', 'type',
+               'progressive', 'mtime_ns', 'result', 'saved', 'ts', 'valid')
+
+    def __init__(it, dbfile):
+        it.lock = threading.Lock()
+        it.dirty = 0
+        it.num_dirs = 0         # folders checked by refresh
+        it.num_rescan = 0       # ...and rescanned
+        it.num_put = 0          # pictures added or updated
+        it.db = sqlite3.connect(dbfile, check_same_thread=False)
+        it.db.execute('create table if not exists dirs ('
+                      'path text primary key, parent text, '
+                      'mtime_ns integer)')
+        it.db.execute('create table if not exists pics ('
+                      'path text primary key, dir text, ext text, '
+                      'size integer, width integer, height integer, '
+                      'type text, progressive integer, mtime_ns integer, '
+                      'result text, saved integer, ts real, '
+                      'valid integer)')
+        if 'valid' not in [r[1] for r in it.db.execute(
+                'pragma table_info(pics)')]:
+            # catalog of old version, rescan every folder to check files
+            it.db.execute('alter table pics add column valid integer')
+            it.db.execute('update dirs set mtime_ns=null')
+        it.db.execute('create index if not exists dirs_parent '
+                      'on dirs (parent)')
+        it.db.execute('create index if not exists pics_dir on pics (dir)')
+        it.db.commit()
+
+    def refresh(it, top, recursive=True):
+        """rescan folders under top whose mtime changed"""
+        stack = [os.path.abspath(top)]
+        while stack:
+            folder = stack.pop()
+            try:
+                st = os.stat(folder)
+            except (FileNotFoundError, NotADirectoryError):
+                it.forget(folder)
+                continue
+            it.num_dirs += 1
+            with it.lock:
+                row = it.db.execute('select mtime_ns from dirs where path=?',
+                                    (folder,)).fetchone()
+                if row is not None and row[0] == st.st_mtime_ns:
+                    subs = [r[0] for r in it.db.execute(
+                            'select path from dirs where parent=?',
+                            (folder,))]
+                else:
+                    subs = None
+            if subs is None: subs = it.rescan(folder, st)
+            if recursive: stack.extend(subs)
+        with it.lock: it.db.commit()
+
+    def rescan(it, folder, st):
+        """update pictures and sub-folders of folder, return sub-folders"""
+        it.num_rescan += 1
+        subs, stats = [], {}
+        try:
+            with os.scandir(folder) as sd:
+                for entry in sd:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subs.append(entry.path)
+                            continue
+                        if (entry.is_file(follow_symlinks=False) is False
+                                or os.path.splitext(entry.name)[1].lower()
+                                not in it.EXTS):
+                            continue
+                        stats[entry.path] = entry.stat(follow_symlinks=False)
+                    except FileNotFoundError:
+                        continue
+        except FileNotFoundError:
+            it.forget(folder)
+            return []
+        with it.lock:
+            old = {r[0]: (r[1], r[2], r[3] is not None)
+                   for r in it.db.execute(
+                       'select path, size, mtime_ns, valid from pics '
+                       'where dir=?', (folder,))}
+            known = [r[0] for r in it.db.execute(
+                'select path from dirs where parent=?', (folder,))]
+        for pathname in old.keys() - stats.keys():
+            with it.lock:
+                it.db.execute('delete from pics where path=?', (pathname,))
+        for pathname, pst in stats.items():
+            if old.get(pathname) != (pst.st_size, pst.st_mtime_ns, True):
+                it.put(pathname, pst)
+        for sub in set(known) - set(subs): it.forget(sub)
+        with it.lock:
+            # new sub-folders have no mtime, and are scanned when reached
+            it.db.executemany('insert or ignore into dirs values (?,?,null)',
+                              [(sub, folder) for sub in subs])
+            it.db.execute('insert or replace into dirs values (?,?,?)',
+                          (folder, os.path.dirname(folder), st.st_mtime_ns))
+        return subs
+
+    def put(it, pathname, st=None, result=None, saved=None):
+        """add or update a picture, read its header, or identify it"""
+        pathname = os.path.abspath(pathname)
+        if st is None: st = os.stat(pathname)
+        ext = os.path.splitext(pathname)[1].lower()
+        info = header.read(pathname)
+        if info is None:
+            kind, width, height, progressive = (
+                ext[1:].replace('jpeg', 'jpg'), None, None, None)
+        else:
+            kind, width, height, progressive = info
+        valid = ((info is not None or sh.identify(pathname))
+                 and os.path.basename(pathname)[0] != '-')
+        if info is None and valid:
+            try:  # identify
+                width, height = map(int, sh.getWxH(pathname).split('x'))
+            except (ValueError, SmallyError):
+                pass
+        with it.lock:
+            it.db.execute(
+                'insert or replace into pics values '
+                '(?,?,?,?,?,?,?,?,?,?,?,?,?)',
+                (pathname, os.path.dirname(pathname), ext, st.st_size,
+                 width, height, kind, progressive, st.st_mtime_ns, result,
+                 saved, None if result is None else time.time(), valid))
+            it.num_put += 1
+            it.dirty += 1
+            if it.dirty >= it.COMMIT_EVERY:
+                it.db.commit()
+                it.dirty = 0
+
+    def optimized(it, pathname, st):
+        """True if pathname is compressed by smally, and unchanged since"""
+        with it.lock:
+            row = it.db.execute(
+                'select size, mtime_ns, result from pics where path=?',
+                (os.path.abspath(pathname),)).fetchone()
+        return (row is not None and row[2] is not None
+                and row[:2] == (st.st_size, st.st_mtime_ns))
+
+    def forget(it, folder):
+        """remove folder and everything under it"""
+        under = folder.rstrip(os.sep) + os.sep
+        with it.lock:
+            it.db.execute('delete from dirs where path=? or '
+                          'substr(path,1,?)=?', (folder, len(under), under))
+            it.db.execute('delete from pics where dir=? or '
+                          'substr(dir,1,?)=?', (folder, len(under), under))
+
+    @staticmethod
+    def where(top, recursive, exts, since_ns=None, valid=True):
+        """sql condition and args of pictures of exts under top"""
+        top = os.path.abspath(top)
+        under = top.rstrip(os.sep) + os.sep
+        sql = 'valid=? and ext in (%s)' % ','.join('?' * len(exts))
+        args = [int(valid)] + list(exts)
+        if recursive:
+            sql += ' and (dir=? or substr(dir,1,?)=?)'
+            args += [top, len(under), under]
+        else:
+            sql += ' and dir=?'
+            args.append(top)
+        if since_ns is not None:
+            sql += ' and mtime_ns>=?'
+            args.append(since_ns)
+        return sql, args
+
+    def pictures(it, top, recursive, exts, since_ns=None, minsize=None,
+                 maxsize=None, minwidth=None, limit=None, valid=True):
+        """dict of each picture matched, biggest first with limit"""
+        sql, args = it.where(top, recursive, exts, since_ns, valid)
+        for cond, value in (('size>=?', minsize), ('size<=?', maxsize),
+                            ('width>=?', minwidth)):
+            if value is not None:
+                sql += ' and ' + cond
+                args.append(value)
+        sql = 'select * from pics where ' + sql
+        if limit is not None:
+            sql += ' order by size desc limit ?'
+            args.append(limit)
+        with it.lock:
+            rows = it.db.execute(sql, args).fetchall()
+        recs = [dict(zip(it.COLUMNS, row)) for row in rows]
+        for rec in recs:
+            if rec['progressive'] is not None:
+                rec['progressive'] = bool(rec['progressive'])
+        return recs
+
+    def sizes(it, top, recursive, exts, since_ns=None, valid=True):
+        """(dir, ext, bytes, number) of pictures matched"""
+        sql, args = it.where(top, recursive, exts, since_ns, valid)
+        with it.lock:
+            return it.db.execute('select dir, ext, sum(size), count(*) '
+                                 'from pics where ' + sql
+                                 + ' group by dir, ext', args).fetchall()
+
+    def info(it):
+        return ('catalog: %d folders checked, %d rescanned, %d pictures '
+                'updated' % (it.num_dirs, it.num_rescan, it.num_put))
+
+    def close(it):
+        with it.lock:
+            it.db.commit()
+            it.db.close()
@@ -1,11 +1,31 @@
 #!/usr/bin/env python3
 import os
 import sys
+import csv
+import json
+import math
+import mmap
+import zlib
+import fcntl
+import heapq
+import random
+import shutil
+import signal
+import hashlib
 import logging
+import resource
 from stat import *
 import time
 from datetime import datetime
 import subprocess
+import tempfile
+import threading
+import contextlib
+import collections
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from header import header
+from backend import backend as jpegtranBackend
 
 
 # use root logger
@@ -19,54 +39,143 @@ FILE_NONREG = ' __Not_Reg_File'
 FILE_NOTPIC = ' __Not_Pic_File_Extension'
 
 
+class SmallyError(Exception):
+    """error of smally itself, instead of sys.exit in helpers"""
+
+
+# outcome of one compressed picture, note is the column shown after path
+result = namedtuple('result', 'path tool before after saved note')
+
+
 class sh():
     """shell command class"""
+    fallback = False  # use identify if header can not be parsed
+    prefix = []       # prepended to argv of compressors, nice & ionice
+    spawned = 0       # number of subprocesses
+    lock = threading.Lock()
+
+    @staticmethod
+    def count(n=1):
+        with sh.lock: sh.spawned += n
+
     @staticmethod
     def cmd(cmd, cwd=None):
         """execute a shell cmd,
         return returncode, stdout, stderr"""
+        sh.count()
         proc = subprocess.run(cmd, shell=True, cwd=cwd,
                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         return proc.returncode, proc.stdout, proc.stderr
 
+    @staticmethod
+    def run(argv):
+        """execute cmd in argv list without shell,
+        return returncode, stdout, stderr"""
+        sh.count()
+        proc = subprocess.run(sh.prefix + argv,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return proc.returncode, proc.stdout, proc.stderr
+
+    @staticmethod
+    def runAll(argvs, times=None, timeout=None):
+        """execute cmds in argv lists concurrently without shell,
+        return a list of (returncode, stdout, stderr),
+        and wall time of each cmd is put in times list if given,
+        cmds still running after timeout seconds are killed, and their
+        returncode is None"""
+        if not argvs: return []
+        sh.count(len(argvs))
+        procs = [subprocess.Popen(sh.prefix + argv, stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE)
+                 for argv in argvs]
+        result = [None] * len(procs)
+        if times is not None: times[:] = [0.0] * len(procs)
+        t0 = time.perf_counter()
+
+        def comm(i):
+            try:
+                left = (None if timeout is None else
+                        max(t0 + timeout - time.perf_counter(), 0))
+                out, err = procs[i].communicate(timeout=left)
+                result[i] = (procs[i].returncode, out, err)
+            except subprocess.TimeoutExpired:
+                procs[i].kill()
+                out, err = procs[i].communicate()
+                result[i] = (None, out, err)
+            if times is not None: times[i] = time.perf_counter() - t0
+        threads = [threading.Thread(target=comm, args=(i,))
+                   for i in range(1, len(procs))]
+        try:
+            for t in threads: t.start()
+            comm(0)
+            for t in threads: t.join()
+        except BaseException:
+            for p in procs: p.kill()
+            for t in threads:
+                if t.ident is not None: t.join()
+            raise
+        return result
+
+    @staticmethod
+    def lower(niceness):
+        """run compressors with lower cpu priority, and idle io class"""
+        sh.prefix = ['nice', '-n', str(niceness)]
+        if sh.which('ionice', silent=True):
+            sh.prefix += ['ionice', '-c', '3']
+
     @staticmethod
     def identify(pathname):
         """identify if a file is a legal picture format."""
+        if header.read(pathname) is not None: return True
+        if sh.fallback is False: return False
         rcode, _, _= sh.cmd('identify %s' % pathname)
         return True if rcode == 0 else False
 
     @staticmethod
-    def which(cmd):
+    def which(cmd, silent=False):
         """use which to check if cmd is in $PATH"""
         cmd_str = 'which %s' % cmd
         rcode, _, err = sh.cmd(cmd_str)
         if rcode != 0:
+            if silent: return False
             log.error('%s: %s can not be found in $PATH ' % (NAME,cmd))
             log.error(err.decode())
             return False
         return True
 
+    @staticmethod
+    def version(cmd):
+        """first line of the version info of cmd"""
+        _, out, err = sh.cmd(cmd)
+        for line in (out+err).decode(errors='replace').splitlines():
+            if line.strip(): return line.strip()
+        return ''
+
     @staticmethod
     def getWxH(pathname):
         """get picture's width x height in pixel"""
+        info = header.read(pathname)
+        if info is not None:
+            return '%dx%d' % (info.width, info.height)
         cmd = 'identify %s | cut -d" " -f 3 | head -n1' % pathname
         rcode, out, err = sh.cmd(cmd)
         if rcode != 0:
-            log.error('%s: error while identify jpg width x height' % NAME)
-            log.error(err.decode())
-            sys.exit(1)
+            raise SmallyError('%s: error while identify jpg width x height\n'
+                              % NAME + err.decode())
         wh = out.decode()
         return wh[:len(wh)-1]
 
     @staticmethod
     def isProgressive(pathname):
         """check if pathname is progressive jpg format"""
+        info = header.read(pathname)
+        if info is not None and info.kind == 'jpg':
+            return info.progressive
         cmd = 'identify -verbose %s | grep Interlace' % pathname
         rcode, out, err = sh.cmd(cmd)
         if rcode != 0:
-            log.error('%s: error while identify jpg format' % NAME)
-            log.error(err.decode())
-            sys.exit(1)
+            raise SmallyError('%s: error while identify jpg format\n'
+                              % NAME + err.decode())
         if out.decode().find('None') == -1:  # progressive found
             return True
         return False
@@ -74,151 +183,925 @@ class sh():
 
 class walk():
     """Walk tree and callback according to ptype."""
-    def __init__(it, ptype, interval, recursive, timewindow):
+    WRITTEN_MAX = 4096
+
+    def __init__(it, ptype, interval, recursive, timewindow, jobs=1,
+                 cache=None, sort=False, journal=None, throttle=None,
+                 metrics=None, deadline=None, maxbytes=None, shard=None,
+                 locking=False, catalog=None):
         it.total = 0            # file number scanned
         it.num_error = 0        # file number error
         it.num_call = 0         # file number processed
         it.num_do = 0           # file number did meaningful action
+        it.num_cached = 0       # file number skipped by cache
+        it.num_resumed = 0      # file number skipped by resume
+        it.saved = 0            # bytes saved by compressing actions
         it.ptype = ptype
         it.interval = interval
         it.recursive = recursive
         it.now = datetime.now()
         it.tw = timewindow
+        it.jobs = jobs          # -j, number of workers
+        it.pool = None
+        it.slots = None         # bound the queue of the pool
+        it.lock = threading.Lock()
+        it.stop = threading.Event()
+        it.cache = cache        # skip files already optimized
+        it.kmt = False          # -k, keep mtime
+        it.sort = sort          # sort entries in each folder by name
+        it.journal = journal    # record progress and temp files
+        it.throttle = throttle  # adaptive delay, instead of interval
+        it.written = None       # {pathname: (ino, mtime_ns)} in watch mode
+        it.metrics = metrics    # per-phase timing and counters
+        it.deadline = deadline  # time.monotonic() to stop calling
+        it.maxbytes = maxbytes  # budget of picture bytes to call
+        it.spent = 0            # bytes called within budget
+        it.left = []            # (pathname, size) left by budget
+        it.cut = False          # walk stopped early by budget
+        it.shard = shard        # (i, n), only files of shard i of n
+        it.locking = locking    # flock each file while doing it
+        it.num_sharded = 0      # file number skipped by shard
+        it.num_locked = 0       # file number skipped by lock
+        it.catalog = catalog    # sqlite catalog of pictures
 
     def incr_num_do(it):
         """called by subclass action section"""
-        it.num_do += 1
+        with it.lock: it.num_do += 1
+
+    def incr_saved(it, saved):
+        """called by subclass action section"""
+        with it.lock: it.saved += saved
+
+    def checkStop(it):
+        """called by workers between steps, raise if Ctrl-C in main"""
+        if it.stop.is_set(): raise KeyboardInterrupt
+
+    @contextlib.contextmanager
+    def workers(it):
+        """start the worker pool if -j, and wait for all jobs at last"""
+        if it.jobs > 1:
+            it.pool = ThreadPoolExecutor(max_workers=it.jobs)
+            it.slots = threading.Semaphore(it.jobs*2)
+        try:
+            yield
+        except KeyboardInterrupt:
+            it.stop.set()  # jobs in flight restore their temp files
+            raise
+        finally:
+            if it.pool is not None:
+                with it.deferred():
+                    it.pool.shutdown(wait=True,
+                                     cancel_futures=it.stop.is_set())
+                it.pool = None
+
+    @contextlib.contextmanager
+    def deferred(it):
+        """Ctrl-C and SIGTERM only stop the jobs while they are joined, so
+        the journal and cache are not closed under the workers"""
+        if threading.current_thread() is not threading.main_thread():
+            yield
+            return
+        sigs = (signal.SIGINT, signal.SIGTERM)
+        old = [signal.getsignal(sig) for sig in sigs]
+        for sig in sigs: signal.signal(sig, lambda *_: it.stop.set())
+        try:
+            yield
+        finally:
+            for sig, handler in zip(sigs, old): signal.signal(sig, handler)
+
+    def call(it, pathname, st=None):
+        """do action inline, or submit it to the worker pool"""
+        if it.pool is None:
+            it.job(pathname, st)
+        else:
+            it.slots.acquire()
+            try:
+                job = it.pool.submit(it.job, pathname, st)
+            except BaseException:
+                it.slots.release()
+                raise
+            job.add_done_callback(it.done)
+        it.num_call += 1
+        if it.throttle is not None:
+            it.throttle.wait(st.st_size if st is not None else 0)
+        else:
+            time.sleep(it.interval)
+
+    def phase(it, name):
+        """time a phase if --metrics"""
+        if it.metrics is None: return contextlib.nullcontext()
+        return it.metrics.phase(name)
+
+    def count(it, name, n=1):
+        """add to a counter if --metrics"""
+        if it.metrics is not None: it.metrics.count(name, n)
+
+    def progressive(it, pathname):
+        with it.phase('progressive'):
+            return sh.isProgressive(pathname)
+
+    def job(it, pathname, st=None):
+        """do action and record it in journal"""
+        with it.flock(pathname, st) as mine:
+            if mine is False: return
+            t0 = time.perf_counter()
+            ok = it.do(pathname)
+            if it.metrics is not None:
+                it.metrics.file(os.path.abspath(pathname),
+                                time.perf_counter()-t0)
+        if ok is False: return  # failed, not done for --resume
+        if it.journal is not None:
+            it.journal.finish(os.path.abspath(pathname))
 
-    def mtimeStr(it, pathname):
-        """get time string can be used by touch -d option"""
-        _, out, _ = sh.cmd('stat -c "%y" ' + pathname)
-        return out.decode()
+    @contextlib.contextmanager
+    def flock(it, pathname, st=None):
+        """advisory lock of pathname, give False if another process has
+        it, or has replaced the file since st, which means it is done
+
+        The file is opened read only, so closing it does not look like a
+        write to --watch. Only if LOCK_EX needs write, as on NFS, it is
+        opened rb+, and the close event is marked as action's own."""
+        if not it.locking:
+            yield True
+            return
+        try:
+            f = open(pathname, 'rb')
+        except FileNotFoundError:
+            yield False
+            return
+        try:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                with it.lock: it.num_locked += 1
+                yield False
+                return
+            except OSError:  # EBADF, LOCK_EX needs write
+                f.close()
+                try:
+                    f = open(pathname, 'rb+')
+                except FileNotFoundError:
+                    yield False
+                    return
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    with it.lock: it.num_locked += 1
+                    yield False
+                    return
+                finally:
+                    it.mark(pathname)
+            now = os.stat(pathname)
+            if st is not None and (now.st_ino, now.st_mtime_ns) != \
+                    (st.st_ino, st.st_mtime_ns):
+                with it.lock: it.num_locked += 1
+                yield False
+                return
+            yield True
+        finally:
+            f.close()
+
+    def sharded(it, pathname, top):
+        """True if pathname is not in --shard i/N, by crc32 of its path
+        relative to top, which is the same on every host"""
+        if it.shard is None: return False
+        i, n = it.shard
+        rel = os.path.relpath(pathname, top)
+        if zlib.crc32(os.fsencode(rel)) % n == i: return False
+        it.num_sharded += 1
+        return True
+
+    def done(it, job):
+        """callback of finished job in pool"""
+        it.slots.release()
+        if job.cancelled(): return
+        e = job.exception()
+        if e is not None and not isinstance(e, KeyboardInterrupt):
+            log.info(repr(e))
+
+    def tmpFile(it, pathname, prefix):
+        """create a temp file in the same folder of pathname, it is
+        journaled before created, so a crash never leaves it untracked"""
+        while True:
+            tmpfile = os.path.join(os.path.dirname(pathname),
+                                   prefix + os.urandom(4).hex())
+            it.track(tmpfile, pathname)
+            try:
+                fd = os.open(tmpfile, os.O_RDWR | os.O_CREAT | os.O_EXCL,
+                             0o600)
+            except FileExistsError:
+                it.untrack(tmpfile)  # not ours
+                continue
+            except BaseException:
+                it.untrack(tmpfile)
+                raise
+            os.close(fd)
+            return tmpfile
+
+    def track(it, tmpfile, pathname):
+        """journal tmpfile as in flight"""
+        if it.journal is not None: it.journal.track(tmpfile, pathname)
+
+    def untrack(it, tmpfile):
+        """journal tmpfile as released"""
+        if it.journal is not None: it.journal.untrack(tmpfile)
+
+    def dropTmp(it, tmpfile):
+        """remove tmpfile if it exists"""
+        try: os.remove(tmpfile)
+        except FileNotFoundError: pass
+        it.untrack(tmpfile)
+
+    def putBack(it, tmpfile, pathname, st):
+        """atomic replace pathname by tmpfile, keep mode and -k mtime"""
+        with it.phase('writeback'):
+            it._putBack(tmpfile, pathname, st)
+
+    def _putBack(it, tmpfile, pathname, st):
+        os.chmod(tmpfile, S_IMODE(st.st_mode))
+        try:
+            os.chown(tmpfile, st.st_uid, st.st_gid)
+        except PermissionError:
+            pass
+        if it.kmt:
+            os.utime(tmpfile, ns=(st.st_atime_ns, st.st_mtime_ns))
+        os.replace(tmpfile, pathname)
+        it.untrack(tmpfile)
+        it.mark(pathname)
+
+    def mark(it, pathname):
+        """in watch mode, the next event of pathname is caused by action"""
+        if it.written is None: return
+        try:
+            st = os.stat(pathname)
+        except FileNotFoundError:
+            return
+        with it.lock:
+            it.written[pathname] = (st.st_ino, st.st_mtime_ns)
+            if len(it.written) > it.WRITTEN_MAX:
+                it.written.pop(next(iter(it.written)))
 
     def do(it, pathname):
-        pass  # please override in subclass if needed
+        pass  # please override in subclass if needed, False if failed
 
-    def check(it, pathname):
+    def check(it, pathname, st=None):
+        # check journal
+        if it.resumed(pathname): return False
+        if st is None: st = os.stat(pathname)
         # check time window
-        if it.tw is not None:
-            td = it.now - datetime.fromtimestamp(os.path.getmtime(pathname))
-            if td.total_seconds() > it.tw: return False
+        if it.inWindow(st) is False: return False
+        # check cache
+        if it.cache is not None and it.cache.hit(pathname, st):
+            it.num_cached += 1
+            return False
         # check file itself
         if (sh.identify(pathname) is False or
                 os.path.basename(pathname)[0] == '-'):
-            log.warning(pathname + FILE_WRONG)
+            it.skip(pathname, FILE_WRONG)
             it.num_error += 1
             return False
         return True
 
-    def after(it):
+    def inWindow(it, st):
+        """True if mtime is in -t time window"""
+        if it.tw is None: return True
+        td = it.now - datetime.fromtimestamp(st.st_mtime)
+        return td.total_seconds() <= it.tw
+
+    def since(it):
+        """-t time window as the oldest mtime_ns, None if no window"""
+        if it.tw is None: return None
+        return int((it.now.timestamp() - it.tw) * 1e9)
+
+    def after(it, files_mode=False):
         pass  # please override in subcleass if needed
 
+    def skip(it, pathname, reason):
+        """report a file which is not a legal picture"""
+        log.warning(pathname + reason)
+
+    def remember(it, pathname, result, saved=0):
+        """record the optimized file in cache and catalog"""
+        if it.cache is not None:
+            it.cache.put(pathname, result, saved)
+        if it.catalog is not None:
+            it.catalog.put(pathname, None, result, saved)
+
+    def resumed(it, pathname):
+        """True if pathname is done in the journal of last run"""
+        if it.journal is not None and it.journal.isDone(pathname):
+            it.num_resumed += 1
+            return True
+        return False
+
+    def skipInfo(it):
+        info = ''
+        if it.cache is not None:
+            info += ', %d skipped by cache' % it.num_cached
+        if it.journal is not None:
+            info += ', %d skipped by resume' % it.num_resumed
+        if it.shard is not None:
+            info += ', %d skipped by shard %d/%d' % ((it.num_sharded,)
+                                                     + it.shard)
+        if it.locking:
+            info += ', %d skipped by lock' % it.num_locked
+        return info
+
     def statInfo(it):
         return (str(it.num_do)
                 +'/'+str(it.num_call)
                 +'/'+str(it.num_error)
                 +'/'+str(it.total))
 
+    def run(it, paths, files):
+        """tree mode or file mode, nothing to do if both are None"""
+        try:
+            if paths is not None:
+                it.start(paths)
+            elif files is not None:
+                it.startFiles(files)
+                it.after(files_mode=True)
+            if it.budgeted() and (paths is not None or files is not None):
+                log.info('%s: budget: %d files, %d bytes left%s'
+                         % (NAME, len(it.left),
+                            sum(size for _, size in it.left),
+                            ' of the part walked' if it.cut else ''))
+        finally:
+            if it.metrics is not None: it.metrics.collect(it)
+
     def start(it, top):
-        for path in top: it.go(path)
+        with it.workers():
+            if it.budgeted():
+                it.schedule(candidate for path in top
+                            for candidate in it.checked(path))
+            else:
+                for path in top: it.go(path)
         it.after()
 
+    def startFiles(it, files):
+        """file mode, -f"""
+        with it.workers():
+            files = [sf for sf in files
+                     if not it.resumed(os.path.abspath(sf))
+                     and not it.sharded(sf, os.curdir)]
+            if it.budgeted():
+                it.schedule((sf, os.stat(sf)) for sf in files)
+                return
+            for sf in files: it.call(sf)
+
+    def budgeted(it):
+        return it.deadline is not None or it.maxbytes is not None
+
+    # expected ratio saved by type, and by progressive (likely optimized),
+    # and of files optimized before, found in cache or catalog
+    GAIN = {'jpg': (0.08, 0.02), 'png': (0.15, 0.15)}
+    GAIN_DONE = 0.01
+    COLLECT = 4     # with --max-bytes, collect this many times the bytes
+
+    def gain(it, pathname, st):
+        """expected bytes saved"""
+        if ((it.cache is not None and it.cache.seen(st)) or
+                (it.catalog is not None
+                 and it.catalog.optimized(pathname, st))):
+            return st.st_size * it.GAIN_DONE
+        info = header.read(pathname)
+        if info is None: return st.st_size * 0.05
+        rate = it.GAIN.get(info.kind, (0.05, 0.05))
+        return st.st_size * rate[1 if info.progressive else 0]
+
+    def schedule(it, candidates):
+        """call candidates by expected savings, biggest first, until time
+        is up, and skip the ones bigger than the bytes left. With a
+        deadline, candidates are only collected in the first half of the
+        time left, the other half is kept for compressing them, and with
+        maxbytes, only until COLLECT times of it, the rest of the tree is
+        not walked."""
+        cutoff = enough = None
+        if it.deadline is not None:
+            now = time.monotonic()
+            cutoff = now + (it.deadline - now) / 2
+        if it.maxbytes is not None: enough = it.maxbytes * it.COLLECT
+        queue, collected = [], 0
+        with it.phase('schedule'):
+            for p, st in candidates:
+                if ((cutoff is not None and time.monotonic() >= cutoff) or
+                        (enough is not None and collected >= enough)):
+                    it.cut = True
+                    log.info('%s: budget: walk stopped, %d files collected'
+                             % (NAME, len(queue)))
+                    break
+                queue.append((-it.gain(p, st), p, st))
+                collected += st.st_size
+            queue.sort(key=lambda c: c[0])
+        for i, (_, pathname, st) in enumerate(queue):
+            if (it.deadline is not None
+                    and time.monotonic() >= it.deadline):
+                it.left += [(p, s.st_size) for _, p, s in queue[i:]]
+                return
+            if (it.maxbytes is not None
+                    and it.spent + st.st_size > it.maxbytes):
+                it.left.append((pathname, st.st_size))
+                continue
+            it.spent += st.st_size
+            it.call(pathname, st)
+
     def go(it, top):
-        for f in sorted(os.listdir(top)):
-            pathname = os.path.abspath(os.path.join(top, f))
+        """pipeline: scan -> candidates -> check -> call"""
+        for pathname, st in it.checked(top): it.call(pathname, st)
+
+    def checked(it, top):
+        """yield (pathname, stat) which pass check"""
+        top = os.path.abspath(top)
+        entries = it.candidates(it.scan(top))
+        while True:
+            with it.phase('walk'):
+                candidate = next(entries, None)
+            if candidate is None: break
+            pathname, st = candidate
+            with it.phase('check'):
+                if it.sharded(pathname, top): continue
+                if it.check(pathname, st) is False:
+                    continue
+            yield pathname, st
+
+    def scan(it, top):
+        """iterative scandir walker, yield DirEntry of every non-folder,
+        files of a folder go first, then its sub-folders"""
+        stack = [os.path.abspath(top)]
+        while stack:
             try:
-                mode = os.stat(pathname, follow_symlinks=False).st_mode
+                sd = os.scandir(stack.pop())
             except FileNotFoundError:
                 continue
-            if S_ISDIR(mode):
-                if it.recursive:
-                    it.go(pathname)       # directory, recurse into it
-                else: continue
-            elif S_ISREG(mode) is False:
-                it.total += 1
-                log.warning(pathname + FILE_NONREG)
-                continue                  # skip all non-regular file
-            else:
-                it.total += 1
-                # get file extension
-                _, file_ext = os.path.splitext(pathname)
-                # call accordingly
-                if file_ext.lower() in it.ptype:
-                    if it.check(pathname) is False:
+            folders = []
+            with sd:
+                entries = sorted(sd, key=lambda e: e.name) if it.sort else sd
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if it.recursive: folders.append(entry.path)
+                            continue
+                    except FileNotFoundError:
                         continue
-                    it.do(pathname)
-                    it.num_call += 1
-                    time.sleep(it.interval)
-                else:
-                    if file_ext.lower() not in ('.jpg','.jpeg',
-                                                '.png','.gif','.webp'):
-                        log.warning(pathname + FILE_NOTPIC)
+                    yield entry
+            stack.extend(reversed(folders))
+
+    def candidates(it, entries):
+        """yield (pathname, stat) of picked entries,
+        only the candidates are stat'ed, others use d_type of DirEntry"""
+        for entry in it.picked(entries):
+            st = it.lstat(entry)
+            if st is not None: yield entry.path, st
+
+    def picked(it, entries):
+        """count and filter entries, yield DirEntry in ptype"""
+        for entry in entries:
+            it.total += 1
+            if entry.is_file(follow_symlinks=False) is False:
+                it.skip(entry.path, FILE_NONREG)
+                continue                  # skip all non-regular file
+            # get file extension
+            _, file_ext = os.path.splitext(entry.name)
+            if file_ext.lower() in it.ptype:
+                yield entry
+            elif file_ext.lower() not in ('.jpg','.jpeg',
+                                          '.png','.gif','.webp'):
+                it.skip(entry.path, FILE_NOTPIC)
+
+    @staticmethod
+    def lstat(entry):
+        """stat of DirEntry, None if it is gone"""
+        try:
+            return entry.stat(follow_symlinks=False)
+        except FileNotFoundError:
+            return None
 
 
 class pShow(walk):
-    """show command"""
-    def __init__(it, ptype, interval, recursive, timewindow, paths, files):
+    """show command
+
+    fmt is text, jsonl or csv. The size predicates and --top are applied
+    on stat in check, before the picture is inspected; the width needs
+    the header. With --top, pictures are kept in a heap of the N biggest
+    and shown at last, and smaller ones are dropped by stat as well.
+    With a catalog, each path is refreshed and the pictures are queried
+    from it, no file is inspected.
+    """
+    FIELDS = ('path','bytes','width','height','type','progressive',
+              'mtime','error')
+
+    def __init__(it, ptype, interval, recursive, timewindow, paths, files,
+                 fmt='text', minsize=None, maxsize=None, minwidth=None,
+                 top=None, **kw):
         it.ptype = ptype
-        super().__init__(ptype, interval, recursive, timewindow)
-        if paths is not None:
-            it.start(paths)
-        else:
-            for sf in files:
-                it.do(sf)
-                time.sleep(interval)
+        super().__init__(ptype, interval, recursive, timewindow, **kw)
+        it.fmt = fmt
+        it.minsize = minsize
+        it.maxsize = maxsize
+        it.minwidth = minwidth
+        it.top = top
+        it.heap = []        # min heap of (bytes, seq, record) with --top
+        it.seq = 0
+        it.filtered = (minsize is not None or maxsize is not None
+                       or minwidth is not None or top is not None)
+        if fmt == 'csv':
+            it.csv = csv.writer(sys.stdout)
+            it.csv.writerow(it.FIELDS)
+        it.run(paths, files)
 
-    def after(it):
+    def after(it, files_mode=False):
+        for _, _, rec in sorted(it.heap, reverse=True): it.emit(rec)
+        it.heap = []
+        if files_mode: return
         if it.ptype != []:
-            log.info('%s: display stat: '%NAME + it.statInfo())
+            info = '%s: display stat: '%NAME + it.statInfo()
+            if it.catalog is not None:
+                info += '\n%s: %s' % (NAME, it.catalog.info())
+            if it.fmt == 'text': log.info(info)
+            else: sys.stderr.write(info + '\n')  # keep stdout parsable
+
+    def go(it, top):
+        """query catalog, or walk"""
+        if it.catalog is None:
+            super().go(top)
+            return
+        it.catalog.refresh(top, it.recursive)
+        for rec in it.catalog.pictures(top, it.recursive, it.ptype,
+                                       it.since(), it.minsize, it.maxsize,
+                                       valid=False):
+            it.total += 1
+            it.skip(rec['path'], FILE_WRONG)
+            it.num_error += 1
+        for rec in it.catalog.pictures(top, it.recursive, it.ptype,
+                                       it.since(), it.minsize, it.maxsize,
+                                       it.minwidth, it.top):
+            it.total += 1
+            it.num_call += 1
+            it.keep({'path': rec['path'], 'bytes': rec['size'],
+                     'width': rec['width'], 'height': rec['height'],
+                     'type': rec['type'], 'progressive': rec['progressive'],
+                     'mtime': rec['mtime_ns']/1e9, 'error': None})
+
+    def skip(it, pathname, reason):
+        if it.fmt == 'text':
+            super().skip(pathname, reason)
+        elif not it.filtered:
+            rec = dict.fromkeys(it.FIELDS)
+            rec.update(path=pathname, error=reason.strip(' _'))
+            it.emit(rec)
+
+    def match(it, st):
+        """size predicates and --top on stat only"""
+        size = st.st_size
+        if it.minsize is not None and size < it.minsize: return False
+        if it.maxsize is not None and size > it.maxsize: return False
+        if it.top is not None:
+            with it.lock:
+                if len(it.heap) >= it.top and size <= it.heap[0][0]:
+                    return False
+        return True
+
+    def check(it, pathname, st=None):
+        if st is None: st = os.stat(pathname)
+        if it.match(st) is False: return False
+        return super().check(pathname, st)
+
+    def inspect(it, pathname):
+        """type, width, height and progressive of picture"""
+        info = header.read(pathname)
+        if info is not None: return info
+        _, ext = os.path.splitext(pathname)
+        kind = ext.lower()[1:].replace('jpeg','jpg')
+        try:  # identify
+            width, height = map(int, sh.getWxH(pathname).split('x'))
+        except ValueError:
+            width, height = None, None
+        return kind, width, height, None
+
+    def emit(it, rec):
+        with it.lock:
+            if it.fmt == 'jsonl':
+                sys.stdout.write(json.dumps(rec) + '\n')
+            elif it.fmt == 'csv':
+                it.csv.writerow(['' if rec[k] is None else rec[k]
+                                 for k in it.FIELDS])
+            else:
+                wxh = '' if rec['width'] is None else \
+                      '%dx%d' % (rec['width'], rec['height'])
+                log.info(rec['path'] + ' ' + wxh
+                         + ' ' + str(round(rec['bytes']/1024,2))+'K')
 
     def do(it, pathname):
-        size = os.path.getsize(pathname)
-        log.info(pathname
-                 + ' ' + sh.getWxH(pathname)
-                 + ' ' + str(round(size/1024,2))+'K')
+        st = os.stat(pathname)
+        if it.match(st) is False: return  # -f, not checked
+        kind, width, height, progressive = it.inspect(pathname)
+        if it.minwidth is not None and (width is None
+                                        or width < it.minwidth):
+            return
+        it.keep({'path': pathname, 'bytes': st.st_size, 'width': width,
+                 'height': height, 'type': kind, 'progressive': progressive,
+                 'mtime': st.st_mtime, 'error': None})
+
+    def keep(it, rec):
+        """emit rec, or push it in the heap of --top"""
+        if it.top is None:
+            it.emit(rec)
+        else:
+            with it.lock:
+                it.seq += 1
+                item = (rec['bytes'], -it.seq, rec)
+                if len(it.heap) < it.top: heapq.heappush(it.heap, item)
+                elif item > it.heap[0]: heapq.heapreplace(it.heap, item)
         it.incr_num_do()
 
 
 class pSize(walk):
-    """size command"""
-    def __init__(it, ptype, interval, recursive, timewindow, paths, files):
-        super().__init__(ptype, interval, recursive, timewindow)
+    """size command
+
+    By default, sizes are summed from stat only, no file is opened, and
+    -j threads run the stat calls, which helps on NFS and other high
+    latency mounts. With validate, each file is checked by header (or
+    identify) as other actions do. Sizes are also summed by folder and
+    by type, and with du, rolled up to folders du levels under each path.
+    With a catalog, each path is refreshed and the sums are queried from
+    it, files which are not valid pictures are summed as well, unless
+    validate.
+    """
+    def __init__(it, ptype, interval, recursive, timewindow, paths, files,
+                 validate=False, du=None, **kw):
+        super().__init__(ptype, interval, recursive, timewindow, **kw)
         it.size = 0
-        if paths is not None:
-            it.start(paths)
-        else:
-            for sf in files:
-                it.do(sf)
-                time.sleep(interval)
-            it.after()
+        it.validate = validate
+        it.du = du
+        it.dirs = collections.Counter()     # folder: bytes
+        it.types = collections.Counter()    # ext: bytes
+        it.ntypes = collections.Counter()   # ext: number of files
+        it.tops = [os.path.abspath(p) for p in paths or []]
+        it.run(paths, files)
 
-    def after(it):
+    def after(it, files_mode=False):
         log.info('%s: total size: '%NAME
                  + str(it.size) + ', '
                  + str(round(it.size/1024,2)) + 'K, '
                  + str(round(it.size/1024/1024,3)) + 'M, '
                  + str(round(it.size/1024/1024/1024,4)) + 'G, '
                  + it.statInfo())
+        if it.catalog is not None:
+            log.info('%s: %s' % (NAME, it.catalog.info()))
+        if it.du is None: return
+        for ext, size in it.types.most_common():
+            log.info('%12d %10sK %8d %s' % (size, round(size/1024,2),
+                                            it.ntypes[ext], ext))
+        for folder, size in it.rollup().most_common():
+            log.info('%12d %10sK %s' % (size, round(size/1024,2), folder))
+
+    def rollup(it):
+        """sum of folders up to du levels under each path"""
+        total = collections.Counter()
+        for top in it.tops:
+            for folder, size in it.dirs.items():
+                if folder != top and not folder.startswith(
+                        top.rstrip(os.sep) + os.sep):
+                    continue
+                rel = os.path.relpath(folder, top)
+                parts = [] if rel == '.' else rel.split(os.sep)
+                for n in range(min(len(parts), it.du) + 1):
+                    total[os.path.join(top, *parts[:n])] += size
+        return total
+
+    def tally(it, pathname, size):
+        _, ext = os.path.splitext(pathname)
+        with it.lock:
+            it.size += size
+            it.dirs[os.path.dirname(pathname)] += size
+            it.types[ext.lower()] += size
+            it.ntypes[ext.lower()] += 1
+
+    def go(it, top):
+        """stat only pipeline: scan -> picked -> stat by -j threads"""
+        if it.catalog is not None:
+            it.catalog.refresh(top, it.recursive)
+            for rec in it.catalog.pictures(top, it.recursive, it.ptype,
+                                           it.since(), valid=False):
+                it.total += 1
+                if (it.validate or
+                        os.path.basename(rec['path'])[0] == '-'):
+                    it.skip(rec['path'], FILE_WRONG)
+                    it.num_error += 1
+                    continue
+                it.num_call += 1
+                it.tally(rec['path'], rec['size'])
+                it.incr_num_do()
+            for folder, ext, size, n in it.catalog.sizes(
+                    top, it.recursive, it.ptype, it.since()):
+                it.size += size
+                it.dirs[folder] += size
+                it.types[ext] += size
+                it.ntypes[ext] += n
+                it.total += n
+                it.num_call += n
+                it.num_do += n
+            return
+        if it.validate:
+            super().go(top)
+            return
+        pending = collections.deque()
+        with ThreadPoolExecutor(max_workers=it.jobs) as pool:
+            for entry in it.picked(it.scan(top)):
+                pending.append((entry.path, pool.submit(it.lstat, entry)))
+                while len(pending) > it.jobs*8 or (
+                        pending and pending[0][1].done()):
+                    it.sized(*pending.popleft())
+            while pending: it.sized(*pending.popleft())
+
+    def sized(it, pathname, future):
+        st = future.result()
+        if st is None or it.inWindow(st) is False: return
+        if os.path.basename(pathname)[0] == '-':
+            it.skip(pathname, FILE_WRONG)
+            it.num_error += 1
+            return
+        it.num_call += 1
+        it.tally(pathname, st.st_size)
+        it.incr_num_do()
 
     def do(it, pathname):
-        it.size += os.path.getsize(pathname)
+        it.tally(os.path.abspath(pathname), os.path.getsize(pathname))
         it.incr_num_do()
 
 
+class pDupes(walk):
+    """dupes command
+
+    Pictures are collected by stat in the walk, then byte-identical ones
+    are found in three rounds: same size, same sha1 of the first and the
+    last BLOCK bytes, and at last same sha1 of the whole file by mmap.
+    Files not bigger than 2*BLOCK are read whole in the second round, so
+    they skip the last. Paths of the same inode count as one file. With
+    link, each duplicate is atomically replaced by a hardlink to the first
+    path of its group on the same device.
+    """
+    BLOCK = 4096
+
+    def __init__(it, ptype, interval, recursive, timewindow, paths, files,
+                 link=False, fmt='text', **kw):
+        super().__init__(ptype, interval, recursive, timewindow, **kw)
+        it.link = link
+        it.fmt = fmt
+        it.bysize = collections.defaultdict(list)
+        it.num_partial = 0          # files hashed by first & last block
+        it.num_full = 0             # files hashed in whole
+        it.num_dupes = 0
+        it.wasted = 0               # bytes of duplicates not linked
+        it.run(paths, files)
+
+    def check(it, pathname, st=None):
+        """stat only, contents are compared after walk"""
+        if it.resumed(pathname): return False
+        if st is None: st = os.stat(pathname)
+        if it.inWindow(st) is False: return False
+        if os.path.basename(pathname)[0] == '-':
+            it.skip(pathname, FILE_WRONG)
+            it.num_error += 1
+            return False
+        return True
+
+    def call(it, pathname, st=None):
+        """collect only, no worker is needed"""
+        it.num_call += 1
+        if st is None: st = os.stat(pathname)
+        if st.st_size == 0: return
+        it.bysize[st.st_size].append((os.path.abspath(pathname), st))
+
+    def after(it, files_mode=False):
+        with ThreadPoolExecutor(max_workers=it.jobs) as pool:
+            for group in it.groups(pool): it.report(group)
+        info = ('%s: dupes: %d duplicates, %d bytes %s, %d/%d files '
+                'hashed partly/fully'
+                % (NAME, it.num_dupes, it.saved if it.link else it.wasted,
+                   'saved' if it.link else 'wasted',
+                   it.num_partial, it.num_full))
+        if not files_mode: info += ', ' + it.statInfo() + it.skipInfo()
+        if it.fmt == 'text': log.info(info)
+        else: sys.stderr.write(info + '\n')  # keep stdout parsable
+
+    def groups(it, pool):
+        """yield lists of (pathname, stat) with identical content"""
+        for size in sorted(it.bysize, reverse=True):
+            inodes = {}             # one path per (dev, ino)
+            for pathname, st in it.bysize[size]:
+                inodes.setdefault((st.st_dev, st.st_ino), (pathname, st))
+            if len(inodes) < 2: continue
+            group = sorted(inodes.values())
+            with it.phase('dupes_partial'):
+                parts = it.refine(pool, group, it.partial)
+            it.num_partial += len(group)
+            for part in parts:
+                if size <= 2*it.BLOCK:
+                    yield part
+                    continue
+                with it.phase('dupes_full'):
+                    fulls = it.refine(pool, part, it.full)
+                it.num_full += len(part)
+                yield from fulls
+
+    @staticmethod
+    def refine(pool, group, key):
+        """split group by key, drop unique and unreadable ones"""
+        split = collections.defaultdict(list)
+        for item, k in zip(group, pool.map(key, group)):
+            if k is not None: split[k].append(item)
+        return [g for g in split.values() if len(g) > 1]
+
+    @staticmethod
+    def partial(item):
+        """sha1 of the first and the last block"""
+        pathname, st = item
+        h = hashlib.sha1()
+        try:
+            with open(pathname, 'rb') as f:
+                h.update(f.read(pDupes.BLOCK))
+                if st.st_size > pDupes.BLOCK:
+                    f.seek(max(st.st_size-pDupes.BLOCK, pDupes.BLOCK))
+                    h.update(f.read(pDupes.BLOCK))
+        except OSError:
+            return None
+        return h.digest()
+
+    @staticmethod
+    def full(item):
+        """sha1 of the whole file by mmap"""
+        pathname, _ = item
+        try:
+            with open(pathname, 'rb') as f, \
+                    mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                return hashlib.sha1(m).digest()
+        except (OSError, ValueError):
+            return None
+
+    def report(it, group):
+        (keep, kst), dupes = group[0], group[1:]
+        it.num_dupes += len(dupes)
+        linked = []
+        for pathname, st in dupes:
+            it.incr_num_do()
+            # space is freed only if it is the last link of inode
+            size = st.st_size if st.st_nlink == 1 else 0
+            if (it.link and st.st_dev == kst.st_dev
+                    and it.hardlink(keep, kst, pathname, st)):
+                linked.append(pathname)
+                it.incr_saved(size)
+            else:
+                it.wasted += size
+        if it.fmt == 'jsonl':
+            sys.stdout.write(json.dumps({
+                'bytes': kst.st_size, 'keep': keep,
+                'dupes': [p for p, _ in dupes],
+                'linked': linked}) + '\n')
+            return
+        log.info('%s %d' % (keep, kst.st_size))
+        for pathname, _ in dupes:
+            log.info('    = ' + pathname
+                     + (' [l]' if pathname in linked else ''))
+
+    def hardlink(it, keep, kst, pathname, st):
+        """atomic replace pathname by a hardlink to keep, if both are
+        unchanged since hashed"""
+        tmpfile = None
+        try:
+            for p, old in ((pathname, st), (keep, kst)):
+                now = os.stat(p)
+                if (now.st_ino, now.st_mtime_ns) != \
+                        (old.st_ino, old.st_mtime_ns):
+                    return False  # changed since hashed
+            tmpfile = it.tmpFile(pathname, '__smally_lnk_')
+            os.remove(tmpfile)
+            os.link(keep, tmpfile)
+            os.replace(tmpfile, pathname)
+            it.untrack(tmpfile)
+            return True
+        except OSError as e:
+            log.error('%s: %s' % (NAME, e))
+            if tmpfile is not None: it.dropTmp(tmpfile)
+            return False
+        except BaseException:
+            if tmpfile is not None: it.dropTmp(tmpfile)
+            raise
+
+
 class pJpegtran(walk):
-    """jpegtran command"""
+    """jpegtran command, the candidates and -copy of each file come from
+    backend"""
+    FMT = {1: ' [b]', 2: ' [p]', 3: ' [a]'}
+
     def __init__(it, ptype, interval, recursive, timewindow,
-                 paths, files, keepmtime):
-        super().__init__(ptype, interval, recursive, timewindow)
-        it.saved = 0
+                 paths, files, keepmtime, predictor=None, backend=None,
+                 **kw):
+        super().__init__(ptype, interval, recursive, timewindow, **kw)
         it.kmt = keepmtime
-        if paths is not None:
-            it.start(paths)
-        else:
-            for sf in files:
-                it.do(sf)
-                time.sleep(interval)
-            it.after(files_mode=True)
+        it.predictor = predictor    # --fast
+        it.backend = backend if backend is not None else jpegtranBackend()
+        it.run(paths, files)
 
     def after(it, files_mode=False):
         if files_mode:
@@ -233,112 +1116,142 @@ class pJpegtran(walk):
                      + str(round(it.saved/1024,2)) + 'K, '
                      + str(round(it.saved/1024/1024,3)) + 'M, '
                      + str(round(it.saved/1024/1024/1024,4)) + 'G, '
-                     + it.statInfo())
+                     + it.statInfo() + it.skipInfo())
+        if it.predictor is not None:
+            log.info('%s: %s' % (NAME, it.predictor.info()))
 
     def do(it, pathname):
         try:
-            basename = os.path.basename(pathname)
-            wd = os.path.dirname(os.path.abspath(pathname))
-            # baseline
-            file_1 = wd + '/'+ '__smally_jpg1_' + basename
-            cmd_1 = 'jpegtran -copy none -optimize %s > %s'%(pathname,file_1)
-            rcode, _, err = sh.cmd(cmd_1)
+            it.optimize(pathname)
+        except Exception as e:
+            log.info(repr(e))
+            return False
+        return True
+
+    def trials(it, pathname, st, modes, copy='none'):
+        """run jpegtran of modes concurrently, return {mode: data}"""
+        times = []
+        outs = sh.runAll([it.backend.argv(m, copy, pathname)
+                          for m in modes], times)
+        it.count('bytes_read', len(modes)*st.st_size)
+        datas = {}
+        for m, (rcode, data, err), t in zip(modes, outs, times):
+            name = it.backend.modes[m][1]
+            if it.metrics is not None:
+                it.metrics.observe('jpegtran_' + name, t)
             if rcode != 0:
-                raise ChildProcessError('%s: error while jpegtran baseline '
-                                        'compression\n' % NAME
+                raise ChildProcessError('%s: error while jpegtran %s '
+                                        'compression\n' % (NAME, name)
                                         + err.decode())
-            # progressive
-            file_2 = wd + '/' + '__smally_jpg2_' + basename
-            cmd_2 = 'jpegtran -copy none -progressive %s > %s' \
-                    % (pathname,file_2)
-            rcode, _, err = sh.cmd(cmd_2)
-            if rcode != 0:
-                raise ChildProcessError(
-                      '%s: error while jpegtran progressive '
-                      'compression\n' % NAME
-                      + err.decode())
-            # choose the smallest one
-            size = os.path.getsize(pathname)
-            size_1 = os.path.getsize(file_1)
-            size_2 = os.path.getsize(file_2)
-            if size <= size_1 and size <= size_2:
-                select_file = 0
-                if size == size_2 and sh.isProgressive(pathname) is False:
-                    select_file = 2  # progressive is preferred
-            else:
-                if size_2 <= size_1: select_file = 2
-                else: select_file = 1
-            # rm & mv
+            datas[m] = data
+        return datas
+
+    def select(it, pathname, size, outs):
+        """0 original, 1 baseline, 2 progressive or 3 arithmetic, the
+        smallest one, progressive is preferred on a tie, and arithmetic
+        only wins if strictly smaller"""
+        select_file, best = 0, size
+        for m in (2, 1, 3):
+            if m in outs and len(outs[m]) < best:
+                select_file, best = m, len(outs[m])
+        if (select_file == 0 and 2 in outs and len(outs[2]) == size
+                and it.progressive(pathname) is False):
+            select_file = 2
+        return select_file
+
+    def optimize(it, pathname):
+        """compress one JPG, return result, raise on error"""
+        pathname = os.path.abspath(pathname)
+        tmpfile = None
+        try:
+            it.checkStop()
+            st = os.stat(pathname)
+            size = st.st_size
+            # --fast, one trial or none if the winner is predicted
+            key = guess = None
+            full = True
+            if it.predictor is not None:
+                key = it.predictor.key(pathname, st)
+                guess = it.predictor.guess(key)
+                if guess is not None and guess != 0 and \
+                        guess not in it.backend.modes:
+                    guess = None
+                full = guess is None or it.predictor.full()
+            if not full and guess == 0:
+                log.info(pathname + ' -- [f]')
+                it.incr_num_do()
+                return result(pathname, 'jpegtran', size, size, 0, '-- [f]')
+            # all candidates of backend, run concurrently into memory
+            copy = it.backend.copies(pathname)
+            outs = it.trials(pathname, st,
+                             tuple(it.backend.modes) if full else (guess,),
+                             copy)
+            select_file = it.select(pathname, size, outs)
+            if full and key is not None:
+                it.predictor.learn(key, select_file, guess)
+            # write back the winner only
+            it.checkStop()
             _log = pathname + ' '
-            if it.kmt: mtime = it.mtimeStr(pathname)
+            saved = 0
             if select_file == 0:  # origin
-                os.remove(file_1)
-                os.remove(file_2)
-                if sh.isProgressive(pathname) is True:
+                if it.progressive(pathname) is True:
                     _log += '-- [p]'
                 else: _log += '-- [b]'
-            elif select_file == 1:  # baseline
-                os.remove(pathname)
-                os.remove(file_2)
-                os.rename(file_1, pathname)
-                saved = size - size_1
+            else:
+                data = outs[select_file]
+                fmt = (it.FMT[select_file] + ' '
+                       + it.backend.flags(select_file, copy))
+                tmpfile = it.tmpFile(pathname, '__smally_jpg_')
+                with open(tmpfile, 'wb') as f: f.write(data)
+                it.count('bytes_written', len(data))
+                it.putBack(tmpfile, pathname, st)
+                tmpfile = None
+                saved = size - len(data)
                 _log += '-' + str(saved) \
                             + ' -' + str(round(saved/size*100,2)) + '%' \
-                            + ' [b]'
-                it.saved += saved
-            else:  # select_file == 2:  # progressive
-                os.remove(pathname)
-                os.remove(file_1)
-                os.rename(file_2, pathname)
-                saved = size - size_2
-                _log += '-' + str(saved) \
-                            + ' -' + str(round(saved/size*100,2)) +'%' \
-                            + ' [p]'
-                it.saved += saved
-            # keep mtime
-            if select_file !=0 and it.kmt:
-                sh.cmd('touch -m -d "'+mtime+'" '+pathname)
+                            + fmt
+                it.incr_saved(saved)
             # log and count
             log.info(_log)
             it.incr_num_do()
-        except Exception as e:
-            log.info(repr(e))
-        except KeyboardInterrupt:
-            if os.path.exists(pathname):
-                try: os.remove(file_1)
-                except FileNotFoundError: pass
-                try: os.remove(file_2)
-                except FileNotFoundError: pass
-            else:
-                if (os.path.exists(file_1) and
-                        os.path.exists(file_2)):
-                    if os.path.getsize(file_1) >= os.path.getsize(file_2):
-                        os.remove(file_1)
-                        os.rename(file_2, pathname)
-                    else:
-                        os.remove(file_2)
-                        os.rename(file_1, pathname)
-                elif os.path.exists(file_2):
-                    os.rename(file_2, pathname)
-                else: os.rename(file_1, pathname)
+            it.remember(pathname, _log[len(pathname)+1:], saved)
+            return result(pathname, 'jpegtran', size, size-saved, saved,
+                          _log[len(pathname)+1:])
+        except BaseException:
+            it.restore(tmpfile)
             raise
 
+    def restore(it, tmpfile):
+        """original is never removed, only the temp file to clean"""
+        if tmpfile is None: return
+        it.dropTmp(tmpfile)
+
 
 class pOptipng(walk):
-    """optipng command"""
+    """optipng command
+
+    With engines, the installed ones of optipng, oxipng, zopflipng and
+    pngcrush run as concurrent trials, killed after timeout seconds, and
+    the smallest valid output wins. Files bigger than cheap only run the
+    cheap engines, or optipng if none of engines is cheap. The winner is
+    shown after the saved bytes.
+    """
+    ENGINES = ('optipng', 'oxipng', 'zopflipng', 'pngcrush')
+    CHEAP = ('optipng', 'oxipng')
+    TOOL = 'optipng'    # of a single run, without engines
+    FIX = True          # -fix, a bigger output is kept
+
     def __init__(it, ptype, interval, recursive, timewindow,
-                 paths, files, keepmtime, level):
-        super().__init__(ptype, interval, recursive, timewindow)
-        it.saved = 0
+                 paths, files, keepmtime, level, engines=None,
+                 timeout=60.0, cheap=1024*1024, **kw):
+        super().__init__(ptype, interval, recursive, timewindow, **kw)
         it.kmt = keepmtime
         it.level = level
-        if paths is not None:
-            it.start(paths)
-        else:
-            for sf in files:
-                it.do(sf)
-                time.sleep(interval)
-            it.after(files_mode=True)
+        it.engines = engines
+        it.timeout = timeout
+        it.cheap = cheap
+        it.wins = collections.Counter()     # engine: files won
+        it.run(paths, files)
 
     def after(it, files_mode=False):
         if files_mode:
@@ -353,50 +1266,416 @@ class pOptipng(walk):
                      + str(round(it.saved/1024,2)) + 'K, '
                      + str(round(it.saved/1024/1024,3)) + 'M, '
                      + str(round(it.saved/1024/1024/1024,4)) + 'G, '
-                     + it.statInfo())
+                     + it.statInfo() + it.skipInfo())
+        if it.engines:
+            log.info('%s: engines won: ' % NAME
+                     + ', '.join('%s %d' % (e, it.wins[e])
+                                 for e in it.ENGINES
+                                 if e in it.engines or it.wins[e]))
 
     def do(it, pathname):
         try:
-            basename = os.path.basename(pathname)
-            wd = os.path.dirname(os.path.abspath(pathname))
-            out_file = wd + '/' + basename + '.smally.out'
-            cmd = 'optipng -fix -%s %s -out %s'%(it.level,pathname,out_file)
-            rcode, _, err = sh.cmd(cmd)
+            it.optimize(pathname)
+        except Exception as e:
+            log.info(repr(e))
+            return False
+        return True
+
+    def argv(it, engine, pathname, out_file):
+        """lossless argv of engine at level"""
+        digit = it.level.split()[0][1:]
+        if engine == 'optipng':
+            return (['optipng','-fix'] + ('-'+it.level).split()
+                    + [pathname,'-out',out_file])
+        if engine == 'oxipng':
+            return ['oxipng','-o','max' if digit == '7' else digit,
+                    '--out',out_file,pathname]
+        if engine == 'zopflipng':
+            return ['zopflipng','-y',pathname,out_file]
+        return ['pngcrush','-q','-reduce',pathname,out_file]
+
+    def valid(it, out_file, info):
+        """out file is a png of the same size in pixel"""
+        out = header.read(out_file)
+        return (out is not None and out.kind == 'png' and (info is None
+                or (out.width, out.height) == (info.width, info.height)))
+
+    def optimize(it, pathname):
+        """compress one PNG, return result, raise on error"""
+        if it.engines: return it.trials(pathname)
+        return it.single(pathname)
+
+    def single(it, pathname):
+        """run it.argv of TOOL into out file, which replaces pathname if
+        smaller, or if bigger with FIX, return result, raise on error"""
+        pathname = os.path.abspath(pathname)
+        out_file = pathname + '.smally.out'
+        try:
+            it.checkStop()
+            st = os.stat(pathname)
+            it.track(out_file, pathname)
+            with it.phase(it.TOOL):
+                rcode, _, err = sh.run(it.argv(it.TOOL, pathname, out_file))
             if rcode != 0:
-                raise ChildProcessError('%s: error while optipng '
-                                        'compression\n' % NAME
+                raise ChildProcessError('%s: error while %s '
+                                        'compression\n' % (NAME, it.TOOL)
                                         + err.decode())
             _log = pathname + ' '
-            size_1 = os.path.getsize(pathname)
+            size_1 = st.st_size
             size_2 = os.path.getsize(out_file)
-            if size_1 == size_2:
+            it.count('bytes_read', size_1)
+            if size_1 == size_2 or (size_2 > size_1 and not it.FIX):
                 _log += '--'
-                os.remove(out_file)
+                saved = 0
+                it.dropTmp(out_file)
             else:
+                it.count('bytes_written', size_2)
                 saved = size_1 - size_2
-                it.saved += saved
+                it.incr_saved(saved)
                 sym = '-' if saved > 0 else '+'
                 fixed = '' if saved > 0 else 'fixed'
                 _log += sym + str(abs(saved)) \
                             + ' ' + sym \
                             + str(round(abs(saved)/size_1*100,2)) \
                             + '%' + fixed
-                if it.kmt: mtime = it.mtimeStr(pathname)
-                os.remove(pathname)
-                os.rename(out_file, pathname)
-                if it.kmt:
-                    sh.cmd('touch -m -d "'+mtime+'" '+pathname)
+                it.putBack(out_file, pathname, st)
+            log.info(_log)
+            it.incr_num_do()
+            it.remember(pathname, _log[len(pathname)+1:], saved)
+            return result(pathname, it.TOOL, size_1, size_1-saved, saved,
+                          _log[len(pathname)+1:])
+        except BaseException:
+            it.restore(pathname, out_file)
+            raise
+
+    def trials(it, pathname):
+        """run engines concurrently, keep the smallest valid output"""
+        pathname = os.path.abspath(pathname)
+        out_files = []
+        try:
+            it.checkStop()
+            st = os.stat(pathname)
+            size_1 = st.st_size
+            engines = [e for e in it.engines
+                       if size_1 <= it.cheap or e in it.CHEAP]
+            if not engines: engines = ['optipng']  # none cheap chosen
+            for e in engines:
+                out_files.append(pathname + '.smally.' + e + '.out')
+                it.track(out_files[-1], pathname)
+            times = []
+            outs = sh.runAll([it.argv(e, pathname, o)
+                              for e, o in zip(engines, out_files)],
+                             times, it.timeout)
+            it.count('bytes_read', len(engines)*size_1)
+            info = header.read(pathname)
+            winner, size_2 = None, size_1
+            for e, o, (rcode, _, err), t in zip(engines, out_files,
+                                                outs, times):
+                if it.metrics is not None: it.metrics.observe(e, t)
+                if rcode is None:
+                    log.warning('%s: %s timeout: %s' % (NAME,e,pathname))
+                    continue
+                if rcode != 0 or not os.path.exists(o): continue
+                size = os.path.getsize(o)
+                if size < size_2 and it.valid(o, info):
+                    winner, size_2 = e, size
+            _log = pathname + ' '
+            saved = 0
+            if winner is None:
+                _log += '--'
+            else:
+                won = out_files[engines.index(winner)]
+                it.count('bytes_written', size_2)
+                it.putBack(won, pathname, st)
+                out_files.remove(won)
+                saved = size_1 - size_2
+                it.incr_saved(saved)
+                _log += '-' + str(saved) \
+                            + ' -' + str(round(saved/size_1*100,2)) + '%' \
+                            + ' [' + winner + ']'
+                with it.lock: it.wins[winner] += 1
+                it.count('won_' + winner)
+            for o in out_files: it.dropTmp(o)
+            out_files = []
             log.info(_log)
             it.incr_num_do()
+            it.remember(pathname, _log[len(pathname)+1:], saved)
+            return result(pathname, winner or 'optipng', size_1,
+                          size_1-saved, saved, _log[len(pathname)+1:])
+        except BaseException:
+            for o in out_files: it.restore(pathname, o)
+            raise
+
+    def restore(it, pathname, out_file):
+        """remove out file, or put it back if pathname is gone"""
+        try:
+            if os.path.exists(pathname):
+                os.remove(out_file)
+            else:
+                os.rename(out_file, pathname)
+        except FileNotFoundError:
+            pass
+        it.untrack(out_file)
+
+
+class pGifsicle(pOptipng):
+    """gifsicle command, lossless -O3, animated GIFs included, the output
+    is kept only if it is smaller"""
+    TOOL = 'gifsicle'
+    FIX = False
+
+    def __init__(it, ptype, interval, recursive, timewindow,
+                 paths, files, keepmtime, **kw):
+        super().__init__(ptype, interval, recursive, timewindow,
+                         paths, files, keepmtime, None, **kw)
+
+    def argv(it, engine, pathname, out_file):
+        return ['gifsicle','-O3',pathname,'-o',out_file]
+
+
+class pCwebp(walk):
+    """cwebp command
+
+    A .webp sibling (pathname + '.webp') is made next to each JPG (lossy,
+    with quality) and PNG (lossless), and kept only if it is smaller than
+    the original, which is never touched. A sibling not older than its
+    original is up to date and skipped in check. With -k, sibling gets the
+    mtime of original.
+    """
+    def __init__(it, ptype, interval, recursive, timewindow,
+                 paths, files, keepmtime, quality=80, **kw):
+        super().__init__(ptype, interval, recursive, timewindow, **kw)
+        it.kmt = keepmtime
+        it.quality = quality
+        it.num_fresh = 0        # file number with sibling up to date
+        it.run(paths, files)
+
+    def after(it, files_mode=False):
+        if files_mode:
+            log.info('%s: total saved: '%NAME
+                     + str(it.saved) + ', '
+                     + str(round(it.saved/1024,2)) + 'K, '
+                     + str(round(it.saved/1024/1024,3)) + 'M, '
+                     + str(round(it.saved/1024/1024/1024,4)) + 'G')
+        else:
+            log.info('%s: total saved: '%NAME
+                     + str(it.saved) + ', '
+                     + str(round(it.saved/1024,2)) + 'K, '
+                     + str(round(it.saved/1024/1024,3)) + 'M, '
+                     + str(round(it.saved/1024/1024/1024,4)) + 'G, '
+                     + it.statInfo() + it.skipInfo()
+                     + ', %d siblings up to date' % it.num_fresh)
+
+    def check(it, pathname, st=None):
+        if st is None: st = os.stat(pathname)
+        try:
+            if os.stat(pathname+'.webp').st_mtime_ns >= st.st_mtime_ns:
+                it.num_fresh += 1
+                return False
+        except FileNotFoundError:
+            pass
+        return super().check(pathname, st)
+
+    def do(it, pathname):
+        try:
+            it.optimize(pathname)
         except Exception as e:
             log.info(repr(e))
-        except KeyboardInterrupt:
-            try:
-                if os.path.exists(out_file):
-                    os.remove(pathname)
-                    os.rename(out_file, pathname)
-            except FileNotFoundError:
-                pass
+            return False
+        return True
+
+    def optimize(it, pathname):
+        """make webp sibling of one JPG or PNG, return result, raise on
+        error, saved is the bytes of sibling less than original"""
+        pathname = os.path.abspath(pathname)
+        sibling = pathname + '.webp'
+        tmpfile = None
+        try:
+            it.checkStop()
+            st = os.stat(pathname)
+            _, ext = os.path.splitext(pathname)
+            opt = ['-lossless'] if ext.lower() == '.png' else \
+                  ['-q', str(it.quality)]
+            tmpfile = it.tmpFile(pathname, '__smally_webp_')
+            with it.phase('cwebp'):
+                rcode, _, err = sh.run(['cwebp','-quiet'] + opt
+                                       + [pathname,'-o',tmpfile])
+            if rcode != 0:
+                raise ChildProcessError('%s: error while cwebp '
+                                        'compression\n' % NAME
+                                        + err.decode())
+            size = st.st_size
+            size_w = os.path.getsize(tmpfile)
+            it.count('bytes_read', size)
+            saved = 0
+            if size_w < size:
+                it.count('bytes_written', size_w)
+                it.putBack(tmpfile, sibling, st)
+                tmpfile = None
+                saved = size - size_w
+                it.incr_saved(saved)
+                _log = (sibling + ' -' + str(saved)
+                        + ' -' + str(round(saved/size*100,2)) + '%')
+            else:  # original is served, stale sibling is removed
+                it.dropTmp(tmpfile)
+                tmpfile = None
+                try: os.remove(sibling)
+                except FileNotFoundError: pass
+                _log = pathname + ' -- [w]'
+                it.remember(pathname, '-- [w]')  # not encoded again
+            log.info(_log)
+            it.incr_num_do()
+            return result(pathname, 'cwebp', size, size-saved, saved,
+                          _log.split(' ', 1)[1])
+        except BaseException:
+            if tmpfile is not None: it.dropTmp(tmpfile)
             raise
 
 
+class pEstimate(pSize):
+    """estimate of a compress action, without running it
+
+    Pictures are only stat'ed as --size does, and put in strata by type
+    and size (power of 2), each keeping a random sample (reservoir) of
+    them. At last, samples are shared by the strata in proportion to their
+    bytes, copied to a scratch folder and compressed there one by one by
+    the idle action, the originals are never touched. Saved bytes, CPU
+    and wall seconds of each stratum are extrapolated by their ratio to
+    its bytes, with a 95% confidence interval from the sample variance.
+    Samples which are not valid pictures are not tried, and the files and
+    bytes of their stratum are cut by the invalid share of its sample.
+    """
+    Z = 1.96
+
+    def __init__(it, ptype, interval, recursive, timewindow, paths, files,
+                 action, samples=100, scratch=None, **kw):
+        it.action = action
+        it.samples = samples
+        it.scratch = scratch    # parent of the scratch folder
+        it.strata = {}          # (ext, log2 size): [files, bytes, sample]
+        it.random = random.Random()
+        super().__init__(ptype, interval, recursive, timewindow,
+                         paths, files, **kw)
+
+    def tally(it, pathname, size):
+        _, ext = os.path.splitext(pathname)
+        key = (ext.lower().replace('.jpeg','.jpg'),
+               int(math.log2(max(size, 1))))
+        with it.lock:
+            it.size += size
+            s = it.strata.setdefault(key, [0, 0, []])
+            s[0] += 1
+            s[1] += size
+            if len(s[2]) < it.samples:
+                s[2].append(pathname)
+            else:
+                i = it.random.randrange(s[0])
+                if i < it.samples: s[2][i] = pathname
+
+    def pick(it):
+        """(stratum, pathname) to try, at least one of each stratum"""
+        picks = []
+        for key, (_, size, pool) in sorted(it.strata.items()):
+            k = max(1, round(it.samples * size / it.size)) if it.size else 1
+            picks += [(key, p)
+                      for p in it.random.sample(pool, min(k, len(pool)))]
+        return picks
+
+    @staticmethod
+    def cputime():
+        """CPU seconds of waited children"""
+        ru = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return ru.ru_utime + ru.ru_stime
+
+    def trial(it, pathname, scratch, i):
+        """(bytes, saved, cpu, wall) of compressing a copy, None on error"""
+        copy = os.path.join(scratch,
+                            '%d_%s' % (i, os.path.basename(pathname)))
+        try:
+            shutil.copyfile(pathname, copy)
+            cpu, wall = it.cputime(), time.perf_counter()
+            r = it.action.optimize(copy)
+            return (r.before, r.saved, it.cputime() - cpu,
+                    time.perf_counter() - wall)
+        except Exception as e:
+            log.info('%s %s' % (pathname, repr(e)))
+            it.num_error += 1
+            return None
+        finally:
+            try: os.remove(copy)
+            except FileNotFoundError: pass
+
+    @staticmethod
+    def extrapolate(n_files, n_bytes, xs, ys):
+        """ratio estimate of the total of y in a stratum of n_files and
+        n_bytes from samples xs (bytes) and ys, and its variance"""
+        n = len(xs)
+        r = sum(ys) / sum(xs) if sum(xs) else 0.0
+        if n < 2 or n >= n_files: return r * n_bytes, 0.0
+        s2 = sum((y - r*x)**2 for x, y in zip(xs, ys)) / (n-1)
+        return r * n_bytes, n_files**2 * (1 - n/n_files) * s2 / n
+
+    def after(it, files_mode=False):
+        picks = it.pick()
+        log.info('%s: estimate: %d files, %d bytes in %d strata, '
+                 '%d sampled' % (NAME, sum(s[0] for s in it.strata.values()),
+                                 it.size, len(it.strata), len(picks)))
+        done = collections.defaultdict(list)
+        # stratum: [files, bytes, valid files, valid bytes] of the picks
+        seen = collections.defaultdict(lambda: [0, 0, 0, 0])
+        scratch = tempfile.mkdtemp(prefix='smally_estimate_', dir=it.scratch)
+        try:
+            for i, (key, pathname) in enumerate(picks):
+                it.checkStop()
+                try:
+                    size = os.path.getsize(pathname)
+                except FileNotFoundError:
+                    continue
+                seen[key][0] += 1
+                seen[key][1] += size
+                if (sh.identify(pathname) is False or
+                        os.path.basename(pathname)[0] == '-'):
+                    it.skip(pathname, FILE_WRONG)
+                    it.num_error += 1
+                    continue
+                seen[key][2] += 1
+                seen[key][3] += size
+                r = it.trial(pathname, scratch, i)
+                if r is not None: done[key].append(r)
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+        # saved, cpu and wall: [total, variance]
+        est = {'saved': [0.0, 0.0], 'cpu': [0.0, 0.0], 'wall': [0.0, 0.0]}
+        unknown = total = 0
+        for key, (n_files, n_bytes, _) in it.strata.items():
+            # invalid files are left out in the share of the sample
+            n, b, n_valid, b_valid = seen[key]
+            if n:
+                n_files = round(n_files * n_valid / n)
+                n_bytes = n_bytes * b_valid / b if b else 0
+            total += n_bytes
+            if not done[key]:
+                unknown += n_bytes
+                continue
+            xs = [r[0] for r in done[key]]
+            for j, name in ((1, 'saved'), (2, 'cpu'), (3, 'wall')):
+                t, v = it.extrapolate(n_files, n_bytes, xs,
+                                      [r[j] for r in done[key]])
+                est[name][0] += t
+                est[name][1] += v
+        ci = {k: it.Z * math.sqrt(v) for k, (_, v) in est.items()}
+        saved = est['saved'][0]
+        pct = saved/total*100 if total else 0.0
+        log.info('%s: estimate: %d bytes of valid pictures' % (NAME, total))
+        log.info('%s: estimate: saved %d bytes (%.3fG) +- %d, '
+                 '%.2f%% +- %.2f%%'
+                 % (NAME, saved, saved/1024**3, ci['saved'], pct,
+                    ci['saved']/total*100 if total else 0.0))
+        log.info('%s: estimate: cpu %.1fs (%.3fh) +- %.1fs, wall %.1fs '
+                 '(%.3fh) +- %.1fs at -j %d'
+                 % (NAME, est['cpu'][0], est['cpu'][0]/3600, ci['cpu'],
+                    est['wall'][0]/it.jobs, est['wall'][0]/3600/it.jobs,
+                    ci['wall']/it.jobs, it.jobs))
+        if unknown:
+            log.info('%s: estimate: %d bytes in strata without a result'
+                     % (NAME, unknown))
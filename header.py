@@ -0,0 +1,137 @@
+import struct
+from collections import namedtuple
+
+
+# kind: 'jpg', 'png', 'gif' or 'webp'
+# progressive: True/False for JPG, interlace flag for PNG, None for others
+picinfo = namedtuple('picinfo', 'kind width height progressive')
+
+
+class header():
+    """Read picture header in process, without identify.
+
+    Only the first few KB are read (JPG segments before SOF are skipped by
+    seek), and None is returned if the header can not be parsed.
+    """
+    HEAD = 64  # bytes read to decide the kind
+
+    @staticmethod
+    def read(pathname):
+        """return picinfo of pathname, or None"""
+        try:
+            with open(pathname, 'rb') as f:
+                head = f.read(header.HEAD)
+                if head[:2] == b'\xff\xd8':
+                    return header.jpg(f)
+                if head[:8] == b'\x89PNG\r\n\x1a\n':
+                    return header.png(head)
+                if head[:6] in (b'GIF87a', b'GIF89a'):
+                    return header.gif(head)
+                if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+                    return header.webp(head)
+        except (OSError, struct.error, ValueError):
+            pass
+        return None
+
+    @staticmethod
+    def jpg(f):
+        """walk JPG markers until SOFn"""
+        f.seek(2)
+        while True:
+            b = f.read(1)
+            if b == b'': return None
+            if b != b'\xff': return None
+            marker = f.read(1)
+            while marker == b'\xff':  # fill bytes
+                marker = f.read(1)
+            if marker == b'': return None
+            m = marker[0]
+            if m == 0x01 or 0xd0 <= m <= 0xd7:  # no length
+                continue
+            if m in (0xd9, 0xda):  # EOI or SOS before SOF
+                return None
+            length = struct.unpack('>H', f.read(2))[0]
+            if length < 2: return None
+            if 0xc0 <= m <= 0xcf and m not in (0xc4, 0xc8, 0xcc):
+                _, h, w = struct.unpack('>BHH', f.read(5))
+                if w == 0: return None
+                return picinfo('jpg', w, h, m in (0xc2, 0xc6, 0xca, 0xce))
+            f.seek(length-2, 1)
+
+    @staticmethod
+    def png(head):
+        """IHDR must be the first chunk"""
+        if head[12:16] != b'IHDR': return None
+        w, h, _, _, _, _, interlace = struct.unpack('>IIBBBBB', head[16:29])
+        if w == 0 or h == 0: return None
+        return picinfo('png', w, h, interlace == 1)
+
+    @staticmethod
+    def gif(head):
+        """logical screen descriptor"""
+        w, h = struct.unpack('<HH', head[6:10])
+        if w == 0 or h == 0: return None
+        return picinfo('gif', w, h, None)
+
+    @staticmethod
+    def webp(head):
+        """VP8, VP8L or VP8X chunk just after RIFF header"""
+        chunk = head[12:16]
+        data = head[20:]
+        if chunk == b'VP8 ':
+            if data[3:6] != b'\x9d\x01\x2a': return None
+            w, h = struct.unpack('<HH', data[6:10])
+            w, h = w & 0x3fff, h & 0x3fff
+        elif chunk == b'VP8L':
+            if data[0] != 0x2f: return None
+            bits = struct.unpack('<I', data[1:5])[0]
+            w = (bits & 0x3fff) + 1
+            h = ((bits >> 14) & 0x3fff) + 1
+        elif chunk == b'VP8X':
+            w = int.from_bytes(data[4:7], 'little') + 1
+            h = int.from_bytes(data[7:10], 'little') + 1
+        else:
+            return None
+        if w == 0 or h == 0: return None
+        return picinfo('webp', w, h, None)
+
+    @staticmethod
+    def jpgmeta(pathname):
+        """(ICC profile found, EXIF orientation or 0) of APPn before SOF,
+        None if not a JPG"""
+        icc, orientation = False, 0
+        try:
+            with open(pathname, 'rb') as f:
+                if f.read(2) != b'\xff\xd8': return None
+                while True:
+                    marker = f.read(2)
+                    if len(marker) < 2 or marker[0] != 0xff: break
+                    m = marker[1]
+                    if m == 0x01 or 0xd0 <= m <= 0xd7: continue
+                    if not 0xe0 <= m <= 0xfe: break  # APPn and COM only
+                    length = struct.unpack('>H', f.read(2))[0]
+                    if length < 2: break
+                    seg = f.read(length-2)
+                    if m == 0xe2 and seg[:12] == b'ICC_PROFILE\0':
+                        icc = True
+                    elif m == 0xe1 and seg[:6] == b'Exif\0\0':
+                        orientation = header.orientation(seg[6:])
+        except (OSError, struct.error):
+            return None
+        return icc, orientation
+
+    @staticmethod
+    def orientation(tiff):
+        """Orientation tag 0x0112 of IFD0, 0 if not found"""
+        if tiff[:2] not in (b'II', b'MM'): return 0
+        e = '<' if tiff[:2] == b'II' else '>'
+        try:
+            ifd = struct.unpack(e+'I', tiff[4:8])[0]
+            n = struct.unpack(e+'H', tiff[ifd:ifd+2])[0]
+            for i in range(n):
+                entry = tiff[ifd+2+i*12:ifd+14+i*12]
+                if struct.unpack(e+'H', entry[:2])[0] == 0x0112:
+                    return struct.unpack(e+'H', entry[8:10])[0]
+        except struct.error:
+            pass
+        return 0
@@ -0,0 +1,102 @@
+import os
+import json
+import logging
+import threading
+from classes import NAME
+
+
+# use root logger
+log = logging.getLogger()
+
+
+class journal():
+    """Crash-safe progress journal of a batch run.
+
+    One json list per line, appended and flushed as the run goes:
+        ["D", path]            path is done
+        ["T", tmpfile, path]   tmpfile is created for path
+        ["R", tmpfile]         tmpfile is released (replaced or removed)
+    A torn last line after crash is ignored while loading, and cut before
+    appending with resume. Temp files which are tracked but not released
+    are orphans, removed at startup, originals are only replaced by
+    atomic rename, so they are never missing because of a crash.
+    """
+    SYNC_EVERY = 100
+
+    def __init__(it, jfile, resume=False):
+        it.lock = threading.Lock()
+        it.done = set()
+        it.lines = 0
+        inflight = {}
+        if os.path.exists(jfile):
+            it.load(jfile, inflight, resume)
+        it.sweep(inflight)
+        if resume and os.path.exists(jfile): it.trim(jfile)
+        it.f = open(jfile, 'a' if resume else 'w')
+        # orphans are swept, not in flight any more
+        for tmpfile in inflight: it.write(['R', tmpfile])
+
+    def load(it, jfile, inflight, resume):
+        with open(jfile) as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue
+                if rec[0] == 'D':
+                    if resume: it.done.add(rec[1])
+                elif rec[0] == 'T':
+                    inflight[rec[1]] = rec[2]
+                elif rec[0] == 'R':
+                    inflight.pop(rec[1], None)
+
+    @staticmethod
+    def trim(jfile):
+        """cut the torn last line, so appending starts on a new line"""
+        with open(jfile, 'rb+') as f:
+            size = f.seek(0, os.SEEK_END)
+            end = size
+            while end > 0:
+                f.seek(max(end-4096, 0))
+                block = f.read(end - max(end-4096, 0))
+                i = block.rfind(b'\n')
+                if i != -1:
+                    end = max(end-4096, 0) + i + 1
+                    break
+                end = max(end-4096, 0)
+            if end != size: f.truncate(end)
+
+    def sweep(it, inflight):
+        """remove orphaned temp files, which may be half written"""
+        for tmpfile in inflight:
+            try:
+                os.remove(tmpfile)
+            except FileNotFoundError:
+                continue
+            log.info('%s: journal: orphan %s removed' % (NAME,tmpfile))
+
+    def write(it, rec):
+        with it.lock:
+            it.f.write(json.dumps(rec) + '\n')
+            it.f.flush()
+            it.lines += 1
+            if it.lines % it.SYNC_EVERY == 0:
+                os.fsync(it.f.fileno())
+
+    def isDone(it, path):
+        return path in it.done
+
+    def finish(it, path):
+        it.write(['D', path])
+
+    def track(it, tmpfile, path):
+        it.write(['T', tmpfile, path])
+
+    def untrack(it, tmpfile):
+        it.write(['R', tmpfile])
+
+    def close(it):
+        with it.lock:
+            it.f.flush()
+            os.fsync(it.f.fileno())
+            it.f.close()
@@ -0,0 +1,151 @@
+import os
+import time
+import json
+import heapq
+import bisect
+import threading
+import contextlib
+
+
+class metrics():
+    """Per-phase timing and counters of a run.
+
+    Each phase has a latency histogram (Prometheus style cumulative
+    buckets, in seconds), counters are plain numbers, and the slowest N
+    files are kept in a heap. It is written as JSON, or as a Prometheus
+    textfile for node_exporter's textfile collector.
+    """
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+
+    def __init__(it, slowest=10):
+        it.lock = threading.Lock()
+        it.phases = {}          # name: [count, sum, [bucket counts]]
+        it.counters = {}
+        it.nslowest = slowest
+        it.slowest = []         # min heap of (seconds, pathname)
+        it.stat = {}
+        it.t0 = time.time()
+        it.t1 = None            # end of merged runs
+
+    def observe(it, name, seconds):
+        with it.lock:
+            p = it.phases.get(name)
+            if p is None:
+                p = it.phases[name] = [0, 0.0, [0]*len(it.BUCKETS)]
+            p[0] += 1
+            p[1] += seconds
+            i = bisect.bisect_left(it.BUCKETS, seconds)
+            if i < len(it.BUCKETS): p[2][i] += 1
+
+    @contextlib.contextmanager
+    def phase(it, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            it.observe(name, time.perf_counter()-t0)
+
+    def count(it, name, n=1):
+        with it.lock:
+            it.counters[name] = it.counters.get(name, 0) + n
+
+    def file(it, pathname, seconds):
+        with it.lock:
+            if len(it.slowest) < it.nslowest:
+                heapq.heappush(it.slowest, (seconds, pathname))
+            elif it.slowest and seconds > it.slowest[0][0]:
+                heapq.heapreplace(it.slowest, (seconds, pathname))
+
+    def collect(it, action):
+        """c/n/e/t and saved of a walk action"""
+        it.stat = {'done': action.num_do, 'called': action.num_call,
+                   'error': action.num_error, 'total': action.total,
+                   'saved': action.saved, 'sharded': action.num_sharded,
+                   'locked': action.num_locked}
+
+    def dump(it):
+        phases = {}
+        for name, (n, total, buckets) in sorted(it.phases.items()):
+            cum, acc = {}, 0
+            for le, b in zip(it.BUCKETS, buckets):
+                acc += b
+                cum[str(le)] = acc
+            cum['+Inf'] = n
+            phases[name] = {'count': n, 'sum': total, 'buckets': cum}
+        return {'start': it.t0, 'seconds': (it.t1 or time.time())-it.t0,
+                'phases': phases, 'counters': dict(it.counters),
+                'files': it.stat,
+                'slowest': [[s, p] for s, p in
+                            sorted(it.slowest, reverse=True)]}
+
+    @staticmethod
+    def label(v):
+        return str(v).replace('\\','\\\\').replace('"','\\"') \
+                     .replace('\n','\\n')
+
+    def prom(it):
+        d = it.dump()
+        lines = ['# HELP smally_phase_seconds time spent in each phase',
+                 '# TYPE smally_phase_seconds histogram']
+        for name, p in d['phases'].items():
+            for le, n in p['buckets'].items():
+                lines.append('smally_phase_seconds_bucket{phase="%s",le="%s"}'
+                             ' %d' % (name, le, n))
+            lines.append('smally_phase_seconds_sum{phase="%s"} %f'
+                         % (name, p['sum']))
+            lines.append('smally_phase_seconds_count{phase="%s"} %d'
+                         % (name, p['count']))
+        for name, n in sorted(d['counters'].items()):
+            lines.append('# TYPE smally_%s_total counter' % name)
+            lines.append('smally_%s_total %d' % (name, n))
+        lines.append('# TYPE smally_files gauge')
+        for state, n in d['files'].items():
+            if state == 'saved': continue
+            lines.append('smally_files{state="%s"} %d' % (state, n))
+        lines.append('# TYPE smally_saved_bytes gauge')
+        lines.append('smally_saved_bytes %d' % d['files'].get('saved', 0))
+        lines.append('# TYPE smally_slowest_file_seconds gauge')
+        for s, p in d['slowest']:
+            lines.append('smally_slowest_file_seconds{path="%s"} %f'
+                         % (it.label(p), s))
+        lines.append('# TYPE smally_run_seconds gauge')
+        lines.append('smally_run_seconds %f' % d['seconds'])
+        lines.append('# TYPE smally_last_run_timestamp_seconds gauge')
+        lines.append('smally_last_run_timestamp_seconds %f' % time.time())
+        return '\n'.join(lines) + '\n'
+
+    @classmethod
+    def merge(cls, dumps, slowest=10):
+        """metrics of shards from their json dumps, t of c/n/e/t is the
+        max, since every shard scans the whole tree, others are summed"""
+        m = cls(slowest)
+        m.t0 = min(d['start'] for d in dumps)
+        m.t1 = max(d['start'] + d['seconds'] for d in dumps)
+        for d in dumps:
+            for name, p in d['phases'].items():
+                q = m.phases.setdefault(name,
+                                        [0, 0.0, [0]*len(cls.BUCKETS)])
+                q[0] += p['count']
+                q[1] += p['sum']
+                prev = 0  # buckets are cumulative in dump
+                for i, le in enumerate(cls.BUCKETS):
+                    q[2][i] += p['buckets'][str(le)] - prev
+                    prev = p['buckets'][str(le)]
+            for name, n in d['counters'].items():
+                m.count(name, n)
+            for state, n in d['files'].items():
+                if state == 'total':
+                    m.stat[state] = max(m.stat.get(state, 0), n)
+                else:
+                    m.stat[state] = m.stat.get(state, 0) + n
+            for s, p in d['slowest']:
+                m.file(p, s)
+        return m
+
+    def write(it, pathname, fmt='json'):
+        """write atomically, textfile collector may read it any time"""
+        text = (it.prom() if fmt == 'prom' else
+                json.dumps(it.dump(), indent=2) + '\n')
+        tmp = pathname + '.tmp'
+        with open(tmp, 'w') as f: f.write(text)
+        os.replace(tmp, pathname)
@@ -0,0 +1,82 @@
+import os
+import json
+import math
+import threading
+from header import header
+
+
+class predictor():
+    """Guess the jpegtran winner of a JPG, for --fast.
+
+    JPGs are put in classes by current format (progressive or baseline),
+    size (power of 2) and bytes per pixel. Each class counts which one won
+    in full trials: 0 original, 1 baseline, 2 progressive, 3 arithmetic
+    (with --arithmetic). Once a class has samples trials and one outcome
+    won at least confidence of them, the files of the class only run the
+    trial of that outcome, or none if the original wins. Every verify-th
+    predicted file still runs the full trials, which keep the classes
+    learning and measure the guesses.
+    Counts can be loaded from and saved to a json file of earlier runs.
+    """
+    def __init__(it, statfile=None, samples=20, confidence=0.95, verify=10):
+        it.statfile = statfile
+        it.samples = samples
+        it.confidence = confidence
+        it.verify = verify
+        it.lock = threading.Lock()
+        # key: [original, baseline, progressive, arithmetic if tried]
+        it.classes = {}
+        it.num_guess = 0        # files predicted
+        it.num_skip = 0         # ...and no trial run
+        it.num_verify = 0       # predicted files with full trials
+        it.num_match = 0
+        if statfile is not None and os.path.exists(statfile):
+            with open(statfile) as f:
+                it.classes = json.load(f)
+
+    @staticmethod
+    def key(pathname, st):
+        info = header.read(pathname)
+        fmt = 'u' if info is None else 'p' if info.progressive else 'b'
+        bpp = 'u'
+        if info is not None and info.width and info.height:
+            bpp = min(int(st.st_size*8 / (info.width*info.height)), 8)
+        return '%s:%d:%s' % (fmt, int(math.log2(max(st.st_size, 1))), bpp)
+
+    def guess(it, key):
+        """predicted outcome, None if not sure"""
+        with it.lock:
+            counts = it.classes.get(key)
+            if counts is None or sum(counts) < it.samples: return None
+            best = max(range(len(counts)), key=lambda i: counts[i])
+            if counts[best] < it.confidence * sum(counts): return None
+            it.num_guess += 1
+            if best == 0: it.num_skip += 1
+            return best
+
+    def full(it):
+        """True if a predicted file should run full trials to verify"""
+        with it.lock:
+            return it.num_guess % it.verify == 0
+
+    def learn(it, key, outcome, guess=None):
+        """count outcome of full trials, and check guess if any"""
+        with it.lock:
+            counts = it.classes.setdefault(key, [0, 0, 0])
+            counts.extend([0] * (outcome+1-len(counts)))
+            counts[outcome] += 1
+            if guess is not None:
+                it.num_verify += 1
+                if guess == outcome: it.num_match += 1
+
+    def info(it):
+        rate = it.num_match/it.num_verify*100 if it.num_verify else 0.0
+        return ('fast: %d predicted, %d skipped, %d verified, '
+                '%d matched (%.2f%%)' % (it.num_guess, it.num_skip,
+                                         it.num_verify, it.num_match, rate))
+
+    def save(it):
+        if it.statfile is None: return
+        tmp = it.statfile + '.tmp'
+        with open(tmp, 'w') as f: json.dump(it.classes, f)
+        os.replace(tmp, it.statfile)
@@ -0,0 +1,81 @@
+import os
+import json
+import stat
+import logging
+import socketserver
+from concurrent.futures import ThreadPoolExecutor
+import api
+from classes import NAME
+
+
+# use root logger
+log = logging.getLogger()
+
+
+class handler(socketserver.StreamRequestHandler):
+    """one json object per line each way:
+        -> {"path": "/abs/a.jpg", "level": "o2", "keepmtime": false}
+        <- {"path": ..., "tool": ..., "before": ..., "after": ...,
+            "saved": ..., "note": ...}  or  {"path": ..., "error": ...}
+    """
+    def handle(it):
+        for line in it.rfile:
+            if not line.strip(): continue
+            reply = it.server.answer(line)
+            it.wfile.write(json.dumps(reply).encode() + b'\n')
+            it.wfile.flush()
+
+
+class server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Compression service on a Unix-domain socket.
+
+    Every connection has its own thread, and the compressing is done by a
+    pool of jobs workers, which share the warm actions of api. ptype limits
+    the picture types accepted, and level is the default of optipng.
+    """
+    daemon_threads = True
+
+    def __init__(it, sockpath, ptype, jobs=1, level='o2', keepmtime=False):
+        it.sockpath = sockpath
+        it.ptype = ptype
+        it.level = level
+        it.keepmtime = keepmtime
+        it.pool = ThreadPoolExecutor(max_workers=jobs)
+        try:  # stale socket of last run
+            if stat.S_ISSOCK(os.stat(sockpath).st_mode): os.remove(sockpath)
+        except FileNotFoundError:
+            pass
+        super().__init__(sockpath, handler)
+
+    def answer(it, line):
+        path = None
+        try:
+            req = json.loads(line)
+            path = req['path']
+            _, ext = os.path.splitext(path)
+            if ext.lower() not in it.ptype:
+                raise api.SmallyError('picture type is not served')
+            r = it.pool.submit(api.optimize, path,
+                               req.get('level', it.level),
+                               req.get('keepmtime', it.keepmtime)).result()
+            return r._asdict()
+        except Exception as e:
+            return {'path': path, 'error': repr(e)}
+
+    def close(it):
+        it.server_close()
+        it.pool.shutdown(wait=True)
+        try: os.remove(it.sockpath)
+        except FileNotFoundError: pass
+
+
+def serve(sockpath, ptype, jobs=1, level='o2', keepmtime=False):
+    """run until Ctrl-C or SIGTERM"""
+    srv = server(sockpath, ptype, jobs, level, keepmtime)
+    log.info('%s: serving on %s' % (NAME, sockpath))
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        srv.close()
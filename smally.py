@@ -3,7 +3,21 @@ import sys
 import logging
 import argparse
 import textwrap
-from classes import sh, pShow, pSize, pJpegtran, pOptipng, NAME
+import json
+import signal
+import time
+from datetime import datetime, timedelta
+from classes import (sh, pShow, pSize, pDupes, pJpegtran, pOptipng,
+                     pGifsicle, pCwebp, pEstimate, SmallyError, NAME)
+from cache import cache
+from journal import journal
+from metrics import metrics
+from throttle import throttle
+from watch import watcher
+from serve import serve
+from predict import predictor
+from backend import backend
+from catalog import catalog
 
 
 log = logging.getLogger()  # get root logger
@@ -58,11 +72,19 @@ def main():
         -r, -i, -t option. -k option is useless with --size.
         $ python3 smally.py -p path --size --jpg --png --gif --webp
         Calculate the total size of all 4 types of pictures.
+        $ python3 smally.py -p uploads -r --size --jpg --png -j 16 --du 2
+        Sizes are summed from stat only, by 16 threads, and also shown by
+        type and by folder up to 2 levels under uploads. Use --validate to
+        check each file by header as other actions do.
 
     7), show info of picture file
         $ python3 smally.py -p path --show --jpg --png
         Show all JPGs and PNGs in path. You can combine --show with
         -r, -t option. -k option is useless with --show.
+        $ python3 smally.py -p path -r --show --jpg --format jsonl \
+                --min-size 1000K --min-width 769 --top 10
+        Show the 10 biggest JPGs over 1000K and 768 pixel wide, as JSON
+        lines. --format csv is also supported.
 
     8), show other files
         $ python3 smally.py -p path --show -r
@@ -77,6 +99,106 @@ def main():
         $ python3 smally.py -f file1 file2 --jpegtran --jpg
         $ python3 smally.py -f file1 file2 --optipng o2 --png
         -f: file mode
+
+    11), parallel workers
+        $ python3 smally.py -p path1 -r --jpegtran --jpg -j 8
+        -j 8 means 8 pictures are processed at the same time. Default is 1.
+        Counters and total saved are aggregated over all workers, and
+        Ctrl-C still restores temp files of all jobs in flight.
+
+    12), skip files already optimized
+        $ python3 smally.py -p path1 -r --jpegtran --jpg --cache db.sqlite
+        --cache records each optimized file by (device, inode, size,
+        mtime_ns) with tool version and level, files unchanged since last
+        run are skipped before any identify or compressor is called.
+        --cache-hash also matches by content, so a restored file with new
+        mtime is still skipped.
+
+    13), find duplicated pictures
+        $ python3 smally.py -p uploads -r --dupes --jpg --png --link
+        Byte-identical pictures are grouped by size, by sha1 of the first
+        and the last blocks, and at last by sha1 of whole file. --link
+        replaces duplicates by hardlinks to the first one of group.
+        --format jsonl reports one group per line.
+
+    14), compression service
+        $ python3 smally.py --serve /run/smally.sock --jpg --png -j 4
+        Keep running, and compress pictures sent to the unix socket, one
+        json per line each way, such as {"path": "/abs/a.jpg"}. In Python,
+        import api and call api.optimize(path) instead.
+
+    15), predict the winner of jpegtran
+        $ python3 smally.py -p path -r --jpegtran --jpg --fast \
+                --fast-stats fast.json
+        JPGs are classed by format, size and bytes per pixel. When a class
+        has a clear winner in earlier full trials, only its trial is run,
+        or none if the original always wins ([f] is shown). One predicted
+        file in 10 still runs full trials, and the match rate is reported.
+
+    16), compress within a time or bytes budget
+        $ python3 smally.py -p uploads -r --jpegtran --jpg --deadline 06:00
+        $ python3 smally.py -p uploads -r --optipng o2 --png \
+                --max-seconds 3600 --max-bytes 10G
+        Pictures are checked first, up to half of the time or 4 times the
+        bytes, then called by expected savings (size, type and progressive),
+        biggest first. No new picture is called after the time, and
+        pictures over the bytes left are skipped. The files and bytes left
+        are reported.
+
+    17), shards on several hosts
+        host1 $ python3 smally.py -p /mnt/uploads -r --jpegtran --jpg \
+                    --shard 0/2 --metrics s0.json
+        host2 $ python3 smally.py -p /mnt/uploads -r --jpegtran --jpg \
+                    --shard 1/2 --metrics s1.json
+        $ python3 smally.py --merge s0.json s1.json
+        Files are split by crc32 of the path relative to -p, and each one
+        is flock'ed while compressed, so overlapping runs or --watch never
+        compress it twice. --merge totals the saved and c/n/e/t of shards.
+
+    18), webp siblings
+        $ python3 smally.py -p uploads -r -k --cwebp 85 --jpg --png
+        a.jpg.webp (quality 85) and b.png.webp (lossless) are made next to
+        the originals, and kept only if smaller. Siblings newer than their
+        originals are skipped, and with --cache, so are the originals
+        which won [w] before.
+
+    19), compress GIF losslessly with gifsicle in batch mode
+        $ python3 smally.py -p path -r -k --gifsicle --gif
+        gifsicle -O3, animated GIFs included, the output is kept only if
+        it is smaller.
+
+    20), multi-engine PNG trials
+        $ python3 smally.py -p path -r --optipng o2 --png \
+                --engines all --engine-timeout 30 --cheap-above 2M
+        optipng, oxipng, zopflipng and pngcrush, those installed, run
+        concurrently on each PNG, the smallest valid output is kept and
+        the winner shown like [oxipng]. PNGs above 2M only run the cheap
+        optipng and oxipng.
+
+    21), jpegtran backend and markers
+        $ python3 smally.py -p path -r --jpegtran --jpg --copy auto \
+                --arithmetic
+        mozjpeg, libjpeg-turbo or libjpeg is detected, and mozjpeg's
+        progressive scans are optimized. --copy auto keeps the ICC profile,
+        or all markers of an EXIF rotated JPG. --arithmetic adds a
+        candidate [a]. Backend and flags of the winner are shown per file.
+
+    22), answer --show and --size from a catalog
+        $ python3 smally.py -p uploads -r --show --jpg --min-width 768 \
+                --top 100 --catalog pics.sqlite
+        $ python3 smally.py -p uploads/2019 -r --size --png \
+                --catalog pics.sqlite
+        The first run fills the catalog, later runs only rescan folders
+        whose mtime changed. --jpegtran, --optipng and --gifsicle record
+        their results in it. --validate counts the files which are not
+        valid pictures in e, as without catalog.
+
+    23), estimate a compressing run
+        $ python3 smally.py -p archive -r --optipng o2 --png -j 16 \
+                --estimate 400 --scratch /var/tmp
+        Pictures are only stat'ed, 400 of them are sampled by type and
+        size, and compressed as copies in /var/tmp. Saved bytes, CPU and
+        wall hours are extrapolated with 95% confidence intervals.
     '''),
         epilog='smally project page: '
                'https://github.com/xinlin-z/smally\n'
@@ -89,11 +211,21 @@ def main():
                         help='paths for the picture folder')
     pfType.add_argument('-f', '--files', nargs='+',
                         help='picture files')
+    pfType.add_argument('--serve', metavar='SOCKET',
+                        help='serve compression jobs on a unix socket')
+    pfType.add_argument('--merge', nargs='+', metavar='JSON',
+                        help='merge --metrics json files of shards')
     #
     parser.add_argument('-i', type=int, metavar='INTERVAL', dest='interval',
                         help='interval time in milliseconds')
+    parser.add_argument('-j', type=int, metavar='JOBS', dest='jobs',
+                        default=1,
+                        help='number of pictures processed in parallel')
     parser.add_argument('-r', action='store_true', dest='recursive',
                         help='recursive into sub-folders')
+    parser.add_argument('--sort', action='store_true',
+                        help='walk each folder in name order, which has to '
+                             'list the whole folder before any work')
     parser.add_argument('-k', action='store_true', dest='keepmtime',
                         help='keep the mtime untouched after compressing')
     parser.add_argument('-t', type=float,
@@ -107,27 +239,178 @@ def main():
     parser.add_argument('--gif', action='store_true')
     parser.add_argument('--webp', action='store_true')
     # group for action type
-    actType = parser.add_mutually_exclusive_group(required=True)
+    actType = parser.add_mutually_exclusive_group()
     actType.add_argument('--show', action='store_true',
                          help='show pathname and size in KB')
     actType.add_argument('--size', action='store_true',
                          help='calculate total size')
+    actType.add_argument('--dupes', action='store_true',
+                         help='find byte-identical pictures')
     actType.add_argument('--jpegtran', action='store_true',
                          help='lossless compress JPGs with jpegtran')
     actType.add_argument(
         '--optipng',
         choices=['o0','o1','o2','o3','o4','o5','o6','o7','o7 -zm1-9'],
         help='lossless compress PNGs with optipng')
+    actType.add_argument('--gifsicle', action='store_true',
+                         help='lossless compress GIFs with gifsicle -O3')
+    actType.add_argument('--cwebp', type=int, nargs='?', const=80,
+                         metavar='QUALITY',
+                         help='make smaller .webp siblings of JPGs (with '
+                              'QUALITY, default 80) and PNGs (lossless)')
+    # show
+    parser.add_argument('--format', choices=('text','jsonl','csv'),
+                        default='text',
+                        help='output format of --show and --dupes (no '
+                             'csv), default text')
+    parser.add_argument('--min-size', type=bytesize, metavar='BYTES',
+                        dest='minsize',
+                        help='--show pictures not smaller than BYTES, '
+                             'K/M/G suffix is allowed')
+    parser.add_argument('--max-size', type=bytesize, metavar='BYTES',
+                        dest='maxsize',
+                        help='--show pictures not bigger than BYTES')
+    parser.add_argument('--min-width', type=int, metavar='PIXELS',
+                        dest='minwidth',
+                        help='--show pictures not narrower than PIXELS')
+    parser.add_argument('--top', type=int, metavar='N',
+                        help='--show the N biggest pictures only')
+    # size
+    parser.add_argument('--validate', action='store_true',
+                        help='--size checks each file by header, instead '
+                             'of stat only')
+    parser.add_argument('--du', type=int, metavar='DEPTH',
+                        help='--size also shows sizes by type, and by '
+                             'folder up to DEPTH levels under paths')
+    # shard
+    parser.add_argument('--shard', type=shard, metavar='I/N',
+                        help='only files of shard I (0 based) of N, by '
+                             'hash of path relative to -p, implies --lock')
+    parser.add_argument('--lock', action='store_true',
+                        help='flock each picture while compressing it, '
+                             'skip the ones locked by other runs')
+    # estimate
+    parser.add_argument('--estimate', type=int, metavar='N',
+                        help='estimate savings and time of --jpegtran, '
+                             '--optipng or --gifsicle from N samples '
+                             'compressed in scratch space, nothing changed')
+    parser.add_argument('--scratch', metavar='DIR',
+                        help='folder of the --estimate scratch space, '
+                             'default is the temp folder')
+    # budget
+    parser.add_argument('--max-seconds', type=float, metavar='SECONDS',
+                        dest='maxseconds',
+                        help='stop calling new pictures after SECONDS, '
+                             'biggest expected savings go first')
+    parser.add_argument('--deadline', type=deadline, metavar='TIME',
+                        help='stop calling new pictures at TIME, HH:MM or '
+                             'YYYY-MM-DDTHH:MM')
+    parser.add_argument('--max-bytes', type=bytesize, metavar='BYTES',
+                        dest='maxbytes',
+                        help='budget of picture bytes to compress, '
+                             'biggest expected savings go first')
+    # jpegtran
+    parser.add_argument('--fast', action='store_true',
+                        help='--jpegtran runs one trial, or none, when the '
+                             'winner can be predicted')
+    parser.add_argument('--fast-stats', metavar='JSON', dest='fast_stats',
+                        help='load and save the statistics of --fast')
+    parser.add_argument('--copy', choices=backend.COPY, default='none',
+                        help='markers --jpegtran keeps, auto chooses per '
+                             'file by ICC profile and EXIF orientation, '
+                             'default none')
+    parser.add_argument('--arithmetic', action='store_true',
+                        help='--jpegtran also tries arithmetic coding, '
+                             'which many browsers can not decode')
+    # optipng
+    parser.add_argument('--engines', metavar='LIST',
+                        help='--optipng runs trials of these PNG engines, '
+                             'comma separated, or all: '
+                             + ','.join(pOptipng.ENGINES))
+    parser.add_argument('--engine-timeout', type=float, default=60.0,
+                        metavar='SECONDS', dest='engine_timeout',
+                        help='kill engine trials of a PNG after SECONDS, '
+                             'default 60')
+    parser.add_argument('--cheap-above', type=bytesize, default=1024*1024,
+                        metavar='BYTES', dest='cheap_above',
+                        help='PNGs above BYTES only run the cheap engines '
+                             'optipng and oxipng, default 1M')
+    # dupes
+    parser.add_argument('--link', action='store_true',
+                        help='--dupes replaces duplicates by hardlinks')
+    # cache
+    parser.add_argument('--cache', metavar='DBFILE',
+                        help='skip files already optimized, which are '
+                             'recorded in this sqlite file')
+    parser.add_argument('--cache-hash', action='store_true',
+                        dest='cache_hash',
+                        help='also match cache by sha1 of file content')
+    # catalog
+    parser.add_argument('--catalog', metavar='DBFILE',
+                        help='--show and --size answer from this sqlite '
+                             'catalog, refreshed by folder mtime, and '
+                             'compressing records results in it')
+    # throttle
+    parser.add_argument('--max-load', type=float, metavar='LOAD',
+                        dest='maxload',
+                        help='back off while 1 minute load average per CPU '
+                             'is higher than LOAD')
+    parser.add_argument('--max-pressure', type=float, metavar='PCT',
+                        dest='maxpressure',
+                        help='back off while cpu or io pressure (PSI some '
+                             'avg10) is higher than PCT')
+    parser.add_argument('--bps', type=int, metavar='BYTES',
+                        help='budget of picture bytes read per second')
+    parser.add_argument('--nice', type=int, metavar='N',
+                        help='run compressors by nice -n N and ionice -c 3')
+    # watch
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running, and compress new pictures in '
+                             'paths as they land (inotify)')
+    parser.add_argument('--settle', type=float, default=2.0,
+                        metavar='SECONDS',
+                        help='quiet time before a new picture is touched '
+                             'in watch mode, default 2.0')
+    # journal
+    parser.add_argument('--journal', metavar='JFILE',
+                        help='record progress and temp files in JFILE, '
+                             'orphaned temp files of a killed run are '
+                             'removed at startup')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip files done in JFILE of last run')
+    # metrics
+    parser.add_argument('--metrics', metavar='FILE',
+                        help='write per-phase timing and counters of the '
+                             'run to FILE')
+    parser.add_argument('--metrics-format', choices=('json','prom'),
+                        default='json', dest='metrics_format',
+                        help='json, or prom for node_exporter textfile '
+                             'collector, default json')
+    parser.add_argument('--slowest', type=int, default=10, metavar='N',
+                        help='number of slowest files in metrics, '
+                             'default 10')
     # version
     parser.add_argument('-V','--version',action='version',version=VER)
     args = parser.parse_args()  # ~ will be expanded
+    if args.merge is not None:
+        merge(args)
+        return
+    # check action, --serve compresses by type, and takes optipng level
+    if args.serve is not None:
+        if (args.show or args.size or args.dupes or args.jpegtran
+                or args.gifsicle or args.cwebp is not None):
+            parser.error('--serve only takes --optipng LEVEL as action')
+    elif not (args.show or args.size or args.dupes or args.jpegtran
+              or args.optipng or args.gifsicle or args.cwebp is not None):
+        parser.error('one of the arguments --show --size --dupes '
+                     '--jpegtran --optipng --gifsicle --cwebp is required')
     # check paths or files
     if args.paths is not None:
         for path in args.paths:
             if not os.path.exists(path):
                 log.info('%s: path %s is not existed.' % (NAME,path))
                 sys.exit(1)
-    else:
+    elif args.files is not None:
         file_exts = set()
         for sfile in args.files:
             _, ext = os.path.splitext(sfile)
@@ -158,6 +441,10 @@ def main():
         else:
             log.info('%s: Interval time must be positive.' % NAME)
             sys.exit(1)
+    # jobs
+    if args.jobs < 1:
+        log.info('%s: Jobs number must be positive.' % NAME)
+        sys.exit(1)
     # time window
     if args.timewindow is not None:
         if args.timewindow <= 0:
@@ -165,28 +452,371 @@ def main():
             sys.exit(1)
         if args.files:
             log.info('%s: Time window will be ignored when -f.' % NAME)
+    # show
+    if ((args.minsize is not None or args.maxsize is not None
+            or args.minwidth is not None or args.top is not None)
+            and not args.show):
+        log.info('%s: --min-size, --max-size, --min-width and --top only '
+                 'work with --show.' % NAME)
+        sys.exit(1)
+    if args.format != 'text' and not (args.show or args.dupes):
+        log.info('%s: --format only works with --show or --dupes.' % NAME)
+        sys.exit(1)
+    if args.top is not None and args.top < 1:
+        log.info('%s: --top must be positive.' % NAME)
+        sys.exit(1)
+    # shard
+    compress = (args.jpegtran or args.optipng or args.gifsicle
+                or args.cwebp is not None)
+    if (args.shard is not None or args.lock) and not compress:
+        log.info('%s: --shard and --lock only work with --jpegtran, '
+                 '--optipng, --gifsicle or --cwebp.' % NAME)
+        sys.exit(1)
+    # budget
+    budget = (args.maxseconds is not None or args.deadline is not None
+              or args.maxbytes is not None)
+    if budget and (args.watch or not compress):
+        log.info('%s: --max-seconds, --deadline and --max-bytes only work '
+                 'with --jpegtran, --optipng, --gifsicle or --cwebp, not '
+                 '--watch.' % NAME)
+        sys.exit(1)
+    if args.maxseconds is not None and args.maxseconds <= 0:
+        log.info('%s: --max-seconds must be positive.' % NAME)
+        sys.exit(1)
+    # estimate
+    if args.estimate is not None:
+        if not (args.jpegtran or args.optipng or args.gifsicle):
+            log.info('%s: --estimate only works with --jpegtran, --optipng '
+                     'or --gifsicle.' % NAME)
+            sys.exit(1)
+        if args.estimate < 1:
+            log.info('%s: --estimate needs at least 1 sample.' % NAME)
+            sys.exit(1)
+        if (args.watch or budget or args.shard is not None or args.lock
+                or args.cache is not None or args.catalog is not None
+                or args.journal is not None):
+            log.info('%s: --estimate does not work with --watch, budgets, '
+                     '--shard, --lock, --cache, --catalog or --journal.'
+                     % NAME)
+            sys.exit(1)
+    if args.scratch is not None and args.estimate is None:
+        log.info('%s: --scratch needs --estimate.' % NAME)
+        sys.exit(1)
+    # jpegtran
+    if args.fast and not args.jpegtran:
+        log.info('%s: --fast only works with --jpegtran.' % NAME)
+        sys.exit(1)
+    if args.fast_stats is not None and not args.fast:
+        log.info('%s: --fast-stats needs --fast.' % NAME)
+        sys.exit(1)
+    if (args.copy != 'none' or args.arithmetic) and not args.jpegtran:
+        log.info('%s: --copy and --arithmetic only work with --jpegtran.'
+                 % NAME)
+        sys.exit(1)
+    # optipng
+    if args.engines is not None:
+        if not args.optipng:
+            log.info('%s: --engines only works with --optipng.' % NAME)
+            sys.exit(1)
+        if args.engines != 'all' and not set(
+                args.engines.split(',')) <= set(pOptipng.ENGINES):
+            log.info('%s: --engines takes all or some of %s.'
+                     % (NAME, ','.join(pOptipng.ENGINES)))
+            sys.exit(1)
+    if args.engine_timeout <= 0:
+        log.info('%s: --engine-timeout must be positive.' % NAME)
+        sys.exit(1)
+    # dupes
+    if args.dupes and args.format == 'csv':
+        log.info('%s: --dupes supports text and jsonl format.' % NAME)
+        sys.exit(1)
+    if args.link and not args.dupes:
+        log.info('%s: --link only works with --dupes.' % NAME)
+        sys.exit(1)
+    # size
+    if (args.validate or args.du is not None) and not args.size:
+        log.info('%s: --validate and --du only work with --size.' % NAME)
+        sys.exit(1)
+    if args.du is not None and args.du < 0:
+        log.info('%s: --du depth must not be negative.' % NAME)
+        sys.exit(1)
+    # cache
+    if args.cache is not None and not (args.jpegtran or args.optipng
+                                       or args.gifsicle
+                                       or args.cwebp is not None):
+        log.info('%s: --cache only works with --jpegtran, --optipng, '
+                 '--gifsicle or --cwebp.' % NAME)
+        sys.exit(1)
+    if args.cache_hash and args.cache is None:
+        log.info('%s: --cache-hash needs --cache.' % NAME)
+        sys.exit(1)
+    # catalog
+    if args.catalog is not None:
+        if not (args.show or args.size or args.jpegtran or args.optipng
+                or args.gifsicle):
+            log.info('%s: --catalog only works with --show, --size, '
+                     '--jpegtran, --optipng or --gifsicle.' % NAME)
+            sys.exit(1)
+        if (args.show or args.size) and (args.files or ptype == []):
+            log.info('%s: --show and --size answer from --catalog with -p '
+                     'and picture types.' % NAME)
+            sys.exit(1)
+    # throttle
+    for v,opt in ((args.maxload,'--max-load'),
+                  (args.maxpressure,'--max-pressure'),
+                  (args.bps,'--bps')):
+        if v is not None and v <= 0:
+            log.info('%s: %s must be positive.' % (NAME,opt))
+            sys.exit(1)
+    # watch
+    if args.watch:
+        if not compress or args.paths is None:
+            log.info('%s: --watch only works with -p and --jpegtran, '
+                     '--optipng, --gifsicle or --cwebp.' % NAME)
+            sys.exit(1)
+        if args.settle < 0:
+            log.info('%s: Settle time must be positive.' % NAME)
+            sys.exit(1)
+    # journal
+    if args.resume and args.journal is None:
+        log.info('%s: --resume needs --journal.' % NAME)
+        sys.exit(1)
+    # metrics
+    if args.slowest < 0:
+        log.info('%s: --slowest must be positive.' % NAME)
+        sys.exit(1)
     # actions
-    if sh.which('identify') is False: sys.exit(1)
+    sh.fallback = sh.which('identify', silent=True)
+    opts = dict(jobs=args.jobs, sort=args.sort)  # options for walk
+    seconds = [s for s in (args.maxseconds, args.deadline) if s is not None]
+    if seconds: opts['deadline'] = time.monotonic() + min(seconds)
+    if args.maxbytes is not None: opts['maxbytes'] = args.maxbytes
+    if args.shard is not None: opts['shard'] = args.shard
+    if args.shard is not None or args.lock: opts['locking'] = True
+    if (args.maxload is not None or args.maxpressure is not None
+            or args.bps is not None):
+        opts['throttle'] = throttle(interval, args.maxload,
+                                    args.maxpressure, args.bps)
+    if args.nice is not None: sh.lower(args.nice)
+    # SIGTERM goes the same way as Ctrl-C, temp files are restored
+    signal.signal(signal.SIGTERM, terminate)
+    if args.journal is not None:
+        opts['journal'] = journal(args.journal, args.resume)
+    if args.metrics is not None:
+        opts['metrics'] = metrics(args.slowest)
+    if args.catalog is not None:
+        opts['catalog'] = catalog(args.catalog)
+    if args.serve is not None:
+        if not set(ptype) <= {'.jpg','.jpeg','.png','.gif'}:
+            log.info('%s: --serve only supports JPG, PNG and GIF.' % NAME)
+            sys.exit(1)
+        serve(args.serve, ptype, args.jobs, args.optipng or 'o2',
+              args.keepmtime)
+        return
+    try:
+        act(args, ptype, interval, opts)
+    except SmallyError as e:
+        log.error(str(e))
+        sys.exit(1)
+    finally:
+        if args.journal is not None: opts['journal'].close()
+        if args.catalog is not None: opts['catalog'].close()
+        if args.metrics is not None:
+            opts['metrics'].count('subprocesses', sh.spawned)
+            opts['metrics'].write(args.metrics, args.metrics_format)
+
+
+def bytesize(s):
+    """argparse type of bytes, with optional K, M or G suffix"""
+    units = {'K': 1024, 'M': 1024**2, 'G': 1024**3}
+    try:
+        if s[-1:].upper() in units:
+            return int(float(s[:-1]) * units[s[-1].upper()])
+        return int(s)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid size: %s' % s)
+
+
+def shard(s):
+    """argparse type of I/N, 0 <= I < N"""
+    try:
+        i, n = map(int, s.split('/'))
+        if 0 <= i < n: return i, n
+    except ValueError:
+        pass
+    raise argparse.ArgumentTypeError('invalid shard: %s' % s)
+
+
+def merge(args):
+    """total of shards from their --metrics json files"""
+    dumps = []
+    for jfile in args.merge:
+        with open(jfile) as f: dumps.append(json.load(f))
+    m = metrics.merge(dumps, args.slowest)
+    st = m.stat
+    saved = st.get('saved', 0)
+    log.info('%s: total saved: '%NAME
+             + str(saved) + ', '
+             + str(round(saved/1024,2)) + 'K, '
+             + str(round(saved/1024/1024,3)) + 'M, '
+             + str(round(saved/1024/1024/1024,4)) + 'G, '
+             + '%d/%d/%d/%d' % (st.get('done', 0), st.get('called', 0),
+                                st.get('error', 0), st.get('total', 0))
+             + ', %d shards, %d skipped by lock'
+             % (len(dumps), st.get('locked', 0)))
+    if args.metrics is not None:
+        m.write(args.metrics, args.metrics_format)
+
+
+def deadline(s):
+    """argparse type of time, HH:MM (next one) or YYYY-MM-DDTHH:MM,
+    return seconds from now"""
+    now = datetime.now()
+    try:
+        if 'T' in s:
+            t = datetime.fromisoformat(s)
+        else:
+            t = datetime.combine(now.date(),
+                                 datetime.strptime(s, '%H:%M').time())
+            if t <= now: t += timedelta(days=1)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid time: %s' % s)
+    return (t - now).total_seconds()
+
+
+def terminate(signum, frame):
+    raise KeyboardInterrupt
+
+
+def watch(action, args):
+    """watch mode, until Ctrl-C or SIGTERM"""
+    try:
+        w = watcher(action, args.paths, args.recursive, args.settle)
+    except OSError as e:
+        log.info('%s: %s' % (NAME,e))
+        sys.exit(1)
+    log.info('%s: watching %s' % (NAME,' '.join(args.paths)))
+    try:
+        w.loop()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        w.close()
+        action.after()
+        if action.metrics is not None: action.metrics.collect(action)
+
+
+def estimate(action, args, ptype, interval, opts):
+    """stat only walk, and compress samples by the idle action"""
+    pEstimate(ptype, interval, args.recursive, args.timewindow, args.paths,
+              args.files, action, args.estimate, args.scratch, **opts)
+
+
+def act(args, ptype, interval, opts):
+    # action created idle
+    paths = None if args.watch or args.estimate else args.paths
+    files = None if args.estimate else args.files
     if args.show:
         pShow(ptype, interval, args.recursive, args.timewindow,
-              args.paths, args.files)
+              args.paths, args.files, args.format, args.minsize,
+              args.maxsize, args.minwidth, args.top, **opts)
     if args.size:
         pSize(ptype, interval, args.recursive, args.timewindow,
-              args.paths, args.files)
+              args.paths, args.files, args.validate, args.du, **opts)
+    if args.dupes:
+        pDupes(ptype, interval, args.recursive, args.timewindow,
+               args.paths, args.files, args.link, args.format, **opts)
     if args.jpegtran:
         if ptype != ['.jpg','.jpeg']:
             log.info('%s: --jpegtran only support JPG.' % NAME)
             sys.exit(1)
         if sh.which('jpegtran') is False: sys.exit(1)
-        pJpegtran(ptype, interval, args.recursive, args.timewindow,
-                  args.paths, args.files, args.keepmtime)
+        jpeg = backend(args.arithmetic, args.copy)
+        if args.arithmetic and not jpeg.arithmetic:
+            log.info('%s: %s has no arithmetic coding.'
+                     % (NAME, jpeg.name()))
+            sys.exit(1)
+        log.info('%s: jpegtran backend: %s' % (NAME, jpeg.name()))
+        if args.cache is not None:
+            opts['cache'] = cache(args.cache, 'jpegtran',
+                                  sh.version('jpegtran -version'),
+                                  'copy ' + args.copy
+                                  + (' arithmetic' if args.arithmetic
+                                     else ''), args.cache_hash)
+        guess = predictor(args.fast_stats) if args.fast else None
+        try:
+            action = pJpegtran(ptype, interval, args.recursive,
+                               args.timewindow, paths, files,
+                               args.keepmtime, guess, jpeg, **opts)
+            if args.watch: watch(action, args)
+            if args.estimate: estimate(action, args, ptype, interval, opts)
+        finally:
+            if args.cache is not None: opts['cache'].close()
+            if guess is not None: guess.save()
     if args.optipng:
         if ptype != ['.png']:
             log.info('%s: --optipng only support PNG.' % NAME)
             sys.exit(1)
         if sh.which('optipng') is False: sys.exit(1)
-        pOptipng(ptype, interval, args.recursive, args.timewindow,
-                 args.paths, args.files, args.keepmtime, args.optipng)
+        engines = None
+        if args.engines is not None:
+            wanted = (pOptipng.ENGINES if args.engines == 'all'
+                      else args.engines.split(','))
+            engines = [e for e in pOptipng.ENGINES if e in wanted
+                       and sh.which(e, silent=True) is not False]
+            log.info('%s: engines: %s' % (NAME, ','.join(engines)))
+        if args.cache is not None:
+            opts['cache'] = cache(args.cache, 'optipng',
+                                  sh.version('optipng -v'),
+                                  args.optipng + (' ' + ','.join(engines)
+                                                  if engines else ''),
+                                  args.cache_hash)
+        try:
+            action = pOptipng(ptype, interval, args.recursive,
+                              args.timewindow, paths, files,
+                              args.keepmtime, args.optipng, engines,
+                              args.engine_timeout, args.cheap_above,
+                              **opts)
+            if args.watch: watch(action, args)
+            if args.estimate: estimate(action, args, ptype, interval, opts)
+        finally:
+            if args.cache is not None: opts['cache'].close()
+    if args.gifsicle:
+        if ptype != ['.gif']:
+            log.info('%s: --gifsicle only support GIF.' % NAME)
+            sys.exit(1)
+        if sh.which('gifsicle') is False: sys.exit(1)
+        if args.cache is not None:
+            opts['cache'] = cache(args.cache, 'gifsicle',
+                                  sh.version('gifsicle --version'),
+                                  'O3', args.cache_hash)
+        try:
+            action = pGifsicle(ptype, interval, args.recursive,
+                               args.timewindow, paths, files,
+                               args.keepmtime, **opts)
+            if args.watch: watch(action, args)
+            if args.estimate: estimate(action, args, ptype, interval, opts)
+        finally:
+            if args.cache is not None: opts['cache'].close()
+    if args.cwebp is not None:
+        if not set(ptype) <= {'.jpg','.jpeg','.png'}:
+            log.info('%s: --cwebp only support JPG and PNG.' % NAME)
+            sys.exit(1)
+        if not 0 <= args.cwebp <= 100:
+            log.info('%s: --cwebp quality must be in 0..100.' % NAME)
+            sys.exit(1)
+        if sh.which('cwebp') is False: sys.exit(1)
+        if args.cache is not None:
+            opts['cache'] = cache(args.cache, 'cwebp',
+                                  sh.version('cwebp -version'),
+                                  'q' + str(args.cwebp), args.cache_hash)
+        try:
+            action = pCwebp(ptype, interval, args.recursive,
+                            args.timewindow, paths, args.files,
+                            args.keepmtime, args.cwebp, **opts)
+            if args.watch: watch(action, args)
+        finally:
+            if args.cache is not None: opts['cache'].close()
 
 
 if __name__ == '__main__':
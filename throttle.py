@@ -0,0 +1,76 @@
+import os
+import time
+
+
+class throttle():
+    """Adaptive delay between pictures, instead of fixed -i sleep.
+
+    System load is sampled at most once per second: 1 minute load average
+    per CPU, and "some avg10" of /proc/pressure/cpu and /proc/pressure/io
+    (PSI, Linux 4.20+). The delay doubles while system is busy and halves
+    while it is idle, -i interval is the lower bound. With bps, the bytes of
+    pictures read per second are also kept under the budget.
+    """
+    MIN_DELAY = 0.05    # first step of back off
+    MAX_DELAY = 30.0
+    SAMPLE = 1.0        # seconds between samples
+    WINDOW = 10.0       # seconds of bps budget window
+
+    def __init__(it, interval=0.0, maxload=None, maxpressure=None, bps=None):
+        it.interval = interval
+        it.maxload = maxload
+        it.maxpressure = maxpressure
+        it.bps = bps
+        it.ncpu = os.cpu_count() or 1
+        it.delay = 0.0
+        it.sampled = 0.0
+        it.t0 = time.monotonic()
+        it.nbytes = 0
+
+    @staticmethod
+    def pressure():
+        """max of cpu and io some avg10, None if PSI is not available"""
+        val = None
+        for res in ('cpu', 'io'):
+            try:
+                with open('/proc/pressure/' + res) as f:
+                    for line in f:
+                        if line.startswith('some'):
+                            avg10 = float(line.split()[1].split('=')[1])
+                            val = avg10 if val is None else max(val, avg10)
+            except (OSError, ValueError, IndexError):
+                pass
+        return val
+
+    def busy(it):
+        if it.maxload is not None:
+            if os.getloadavg()[0]/it.ncpu > it.maxload: return True
+        if it.maxpressure is not None:
+            psi = it.pressure()
+            if psi is not None and psi > it.maxpressure: return True
+        return False
+
+    def adapt(it):
+        """sample system load and adjust delay"""
+        now = time.monotonic()
+        if now - it.sampled < it.SAMPLE: return
+        it.sampled = now
+        if it.busy():
+            it.delay = min(max(it.delay*2, it.MIN_DELAY), it.MAX_DELAY)
+        else:
+            it.delay = it.delay/2 if it.delay > it.MIN_DELAY else 0.0
+
+    def budget(it, nbytes):
+        """seconds to sleep to keep bytes per second under bps"""
+        if it.bps is None: return 0.0
+        now = time.monotonic()
+        if now - it.t0 > it.WINDOW:
+            it.t0 = now
+            it.nbytes = 0
+        it.nbytes += nbytes
+        return max(it.nbytes/it.bps - (now-it.t0), 0.0)
+
+    def wait(it, nbytes=0):
+        """called after each picture"""
+        it.adapt()
+        time.sleep(max(it.interval, it.delay, it.budget(nbytes)))
@@ -0,0 +1,160 @@
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+from stat import S_ISREG
+from classes import NAME
+
+
+# use root logger
+log = logging.getLogger()
+
+
+# inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+EVENT = struct.Struct('iIII')  # wd, mask, cookie, len
+
+
+class watcher():
+    """Feed new pictures to a walk action as they land, by inotify.
+
+    Close-write and moved-to events of the watched folders (recursively
+    with -r) put the pathname into pending, and it is fed to action.check
+    and action.call only after it has been quiet for settle seconds, so
+    files still being written are not touched. The events caused by the
+    action's own write-back are recognized by action.written and ignored.
+    Memory is bounded by the number of folders and pending files.
+    """
+    MASK = (IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+            | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+    def __init__(it, action, paths, recursive, settle=2.0):
+        it.action = action
+        it.recursive = recursive
+        it.settle = settle
+        it.wds = {}             # wd: folder
+        it.pending = {}         # pathname: deadline
+        it.libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                              use_errno=True)
+        it.fd = it.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if it.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        action.written = {}
+        it.roots = [os.path.abspath(path) for path in paths]  # for --shard
+        for path in paths:
+            it.addTree(os.path.abspath(path), feed=False)
+
+    def addWatch(it, folder):
+        wd = it.libc.inotify_add_watch(it.fd, os.fsencode(folder), it.MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR): return
+            raise OSError(err, 'inotify_add_watch failed: ' + folder)
+        it.wds[wd] = folder
+
+    def addTree(it, top, feed=True):
+        """watch top (and sub-folders if -r), feed files already in the
+        new folders, they may land before the watch is added"""
+        stack = [top]
+        while stack:
+            folder = stack.pop()
+            it.addWatch(folder)
+            try:
+                with os.scandir(folder) as sd:
+                    for entry in sd:
+                        if entry.is_dir(follow_symlinks=False):
+                            if it.recursive: stack.append(entry.path)
+                        elif feed:
+                            it.defer(entry.path)
+            except (FileNotFoundError, NotADirectoryError):
+                pass
+
+    def defer(it, pathname):
+        it.pending[pathname] = time.monotonic() + it.settle
+
+    def read(it):
+        try:
+            buf = os.read(it.fd, 64*1024)
+        except BlockingIOError:
+            return
+        off = 0
+        while off < len(buf):
+            wd, mask, _, size = EVENT.unpack_from(buf, off)
+            name = buf[off+EVENT.size:off+EVENT.size+size].rstrip(b'\0')
+            off += EVENT.size + size
+            if mask & IN_Q_OVERFLOW:
+                log.warning('%s: watch: inotify queue overflow, '
+                            'some events are lost' % NAME)
+                continue
+            if mask & IN_IGNORED:
+                it.wds.pop(wd, None)  # folder is gone
+                continue
+            folder = it.wds.get(wd)
+            if folder is None or name == b'': continue
+            pathname = os.path.join(folder, os.fsdecode(name))
+            if mask & IN_ISDIR:
+                if it.recursive and mask & (IN_CREATE | IN_MOVED_TO):
+                    it.addTree(pathname)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                it.defer(pathname)
+
+    def flush(it):
+        """feed pathnames which are quiet enough"""
+        now = time.monotonic()
+        for pathname, deadline in list(it.pending.items()):
+            if deadline > now: continue
+            del it.pending[pathname]
+            it.feed(pathname)
+
+    def feed(it, pathname):
+        act = it.action
+        _, ext = os.path.splitext(pathname)
+        if ext.lower() not in act.ptype: return
+        try:
+            st = os.stat(pathname, follow_symlinks=False)
+        except FileNotFoundError:
+            return
+        if not S_ISREG(st.st_mode): return
+        if time.time() - st.st_mtime < it.settle:
+            it.defer(pathname)  # still being written
+            return
+        with act.lock:
+            mine = act.written.pop(pathname, None)
+        if mine == (st.st_ino, st.st_mtime_ns):
+            return  # written back by action itself
+        act.total += 1
+        root = max((r for r in it.roots
+                    if pathname.startswith(r.rstrip(os.sep) + os.sep)),
+                   key=len, default=os.path.dirname(pathname))
+        if act.sharded(pathname, root): return
+        if act.check(pathname, st) is False: return
+        act.call(pathname, st)
+
+    def loop(it):
+        """run until Ctrl-C or SIGTERM"""
+        with it.action.workers():
+            while True:
+                timeout = None
+                if it.pending:
+                    timeout = max(min(it.pending.values())
+                                  - time.monotonic(), 0)
+                r, _, _ = select.select([it.fd], [], [], timeout)
+                if r: it.read()
+                it.flush()
+
+    def close(it):
+        os.close(it.fd)